@@ -3,6 +3,7 @@ from flask_cors import CORS
 from flask_restful import Api
 from app_config import host, port
 from semantic_similarity.main import QnodeSimilarity
+from semantic_similarity.main import PairSimilarity
 from semantic_similarity.main import NN
 
 # from semantic_similarity.main import Paths
@@ -14,6 +15,7 @@ api = Api(app)
 
 api.add_resource(NN, '/nearest-neighbors')
 api.add_resource(QnodeSimilarity, '/similarity_api')
+api.add_resource(PairSimilarity, '/similarity_pairs')
 # api.add_resource(Paths, '/paths')
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
+import io
 import os
 import requests
-import json
 import pandas as pd
 
 
@@ -10,13 +10,12 @@ def call_semantic_similarity(input_file, url):
     files = {
         'file': (file_name, open(input_file, mode='rb'), 'application/octet-stream')
     }
-    resp = requests.post(url, files=files, params={'similarity_types': 'all'})
-    
-    s = resp.json()
-    if isinstance(s, str):
-        s = json.loads(s)
-    
-    return pd.DataFrame(s)
+    # request the results as TSV which can be parsed directly without any JSON decoding
+    # (use 'arrow' or 'parquet' instead to get typed columns if pyarrow is installed):
+    resp = requests.post(url, files=files, params={'similarity_types': 'all', 'output_format': 'tsv'})
+    resp.raise_for_status()
+
+    return pd.read_csv(io.StringIO(resp.text), dtype={'q1': object, 'q2': object}, sep='\t')
 
 url = 'https://kgtk.isi.edu/similarity_api'
 df = call_semantic_similarity('issue_4.tsv', url)
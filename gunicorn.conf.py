@@ -0,0 +1,33 @@
+"""
+Gunicorn configuration for the multi-process serving mode.  Run from the
+repository root with:
+
+    gunicorn -c gunicorn.conf.py application:app
+
+The application, the FAISS index and all memory-mapped embeddings and array
+structures are loaded once in the master process and then shared copy-on-write
+by all forked workers.  Graph cache connections are opened by each worker after
+the fork.  The number of workers and threads per worker can be controlled with
+the KGTK_SIMILARITY_WORKERS and KGTK_SIMILARITY_THREADS environment variables.
+"""
+
+import os
+
+from app_config import host, port
+
+
+bind = f'{host}:{port}'
+workers = int(os.environ.get('KGTK_SIMILARITY_WORKERS', os.cpu_count() or 1))
+threads = int(os.environ.get('KGTK_SIMILARITY_THREADS', 4))
+preload_app = True
+timeout = 300
+
+
+def when_ready(server):
+    # runs in the master after the application was preloaded but before any workers are forked:
+    import semantic_similarity.kypher as kypher
+    kypher.preload_backend()
+
+def post_fork(server, worker):
+    import semantic_similarity.kypher as kypher
+    kypher.reset_backend_after_fork()
@@ -0,0 +1,49 @@
+#!/bin/bash
+
+# Transcode embedding vectors directly into memory-mapped Numpy files plus numids files.
+# This is an alternative to 'build-graph-cache-embed.sh' which avoids importing base64-encoded
+# vectors into SQLite.  The resulting numids files are loaded into the main graph cache by
+# 'build-graph-cache-main.sh' and the .npy files can be used directly as *_EMBEDDINGS files.
+
+KGTK_SIM_HOME=$HOME/Projects/kgtk/code/kgtk-similarity
+KGTK_ENV=ksink39
+
+WIKIDATA_VERSION=wikidata-20210215-dwd-v2
+KGTK_DATA_HOME=kgtk:/datasets/$WIKIDATA_VERSION
+
+COMPLEX_EMB_FILE=wikidatadwd.complEx.graph-embeddings.txt
+TRANSE_EMB_FILE=wikidatadwd.transE.graph-embeddings.txt
+TEXT_EMB_FILE=text-embeddings-concatenated.tsv.gz
+
+DB_HOME=/data/tmp
+EMB_PREFIX=$DB_HOME/$WIKIDATA_VERSION-similarity-embed.`date +%FT%R`
+
+# number of parallel vector parsing processes:
+WORKERS=16
+
+. $HOME/miniconda3/bin/activate ${KGTK_ENV}
+
+# use -0 to let everything through:
+HEAD="-0"
+
+
+date
+set -x
+
+rclone cat $KGTK_DATA_HOME/$TEXT_EMB_FILE | zcat | head -n $HEAD \
+     | time $KGTK_SIM_HOME/scripts/transcode_vectors.py --format kgtk --input-label text_embedding \
+            --output-format npy --output $EMB_PREFIX.text.npy --numids $EMB_PREFIX.textemb.numids.tsv --workers $WORKERS
+gzip $EMB_PREFIX.textemb.numids.tsv
+date
+
+rclone cat $KGTK_DATA_HOME/$COMPLEX_EMB_FILE | head -n $HEAD \
+     | time $KGTK_SIM_HOME/scripts/transcode_vectors.py --format plain \
+            --output-format npy --output $EMB_PREFIX.complex.npy --numids $EMB_PREFIX.complexemb.numids.tsv --workers $WORKERS
+gzip $EMB_PREFIX.complexemb.numids.tsv
+date
+
+rclone cat $KGTK_DATA_HOME/$TRANSE_EMB_FILE | head -n $HEAD \
+     | time $KGTK_SIM_HOME/scripts/transcode_vectors.py --format plain \
+            --output-format npy --output $EMB_PREFIX.transe.npy --numids $EMB_PREFIX.transeemb.numids.tsv --workers $WORKERS
+gzip $EMB_PREFIX.transeemb.numids.tsv
+date
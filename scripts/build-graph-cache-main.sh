@@ -33,6 +33,10 @@ export TMPDIR=$DB_HOME
 
 KGTK_HEADER=/tmp/kgtk-header.tsv
 
+# language of the node info table labels, which needs to be recorded as KG_NODE_INFO_LANGUAGE
+# in the configuration (its labels are only used if that matches DEFAULT_LANGUAGE):
+NODE_INFO_LANGUAGE=en
+
 
 . $HOME/miniconda3/bin/activate ${KGTK_ENV}
 PYTHONPATH=$KGTK_CODE_HOME
@@ -91,5 +95,22 @@ zcat $LOCAL_DATA_HOME2/$TEXT_EMB_NUMIDS_FILE | head -n $HEAD | time kgtk --debug
 eval $MEASURE_SPACE
 date
 
+# denormalized per-node info table with label, class counts and embedding numids, so all details
+# of a batch of nodes can be looked up with a single query; the numids graph defines the node set:
+time kgtk --debug query --graph-cache $DWD_CACHE \
+     -i numids -i labels -i classcounts_compact -i classcounts -i complexemb_numids -i transeemb_numids -i textemb_numids \
+     --match 'numids: (n)-[]->()' \
+     --opt 'labels: (n)-[]->(l)' --where "kgtk_lqstring_lang(l) = \"$NODE_INFO_LANGUAGE\"" \
+     --opt 'classcounts_compact: (n)-[]->(ccs)' \
+     --opt 'classcounts: (n)-[]->(cc)' \
+     --opt 'complexemb_numids: (n)-[]->(cnum)' \
+     --opt 'transeemb_numids: (n)-[]->(tnum)' \
+     --opt 'textemb_numids: (n)-[]->(xnum)' \
+     --return 'n as node1, "nodeinfo" as label, l as node2, ccs as classcounts, cc as classcount, cnum as complexemb_numid, tnum as transeemb_numid, xnum as textemb_numid' \
+     | kgtk add-id \
+     | time kgtk --debug query -i - --as nodeinfo --idx node1 --graph-cache $DWD_CACHE --limit 5
+eval $MEASURE_SPACE
+date
+
 time pigz -6 -p 8 -b 2048 $DWD_CACHE
 date
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Utility to build a cosine-similarity FAISS index over a memory-mapped float32
+# embeddings file (a .npy file or a raw float32 file plus --ndim).  Vectors are
+# unit-normalized on the fly (which is a no-op for embeddings that were already
+# normalized with 'normalize_vectors.py') and indexed with the inner product
+# metric, so index scores are cosine similarities and a top-k search directly
+# returns the true top-k most similar nodes.  Index IDs are the row numbers of
+# the embeddings file, which is what the similarity service expects.  To use the
+# output, point the respective *_EMB_FAISS_INDEX config key to it.
+
+import sys
+import os
+import os.path
+import numpy as np
+import faiss
+import argparse
+
+script_name = os.path.basename((len(sys.argv) > 0 and sys.argv[0]) or '')
+script_home = os.path.dirname((len(sys.argv) > 0 and sys.argv[0]) or '')
+
+
+### Command-line argument handling:
+
+DEFAULT_INDEX_TYPE = 'ivf'
+DEFAULT_NLIST = 8192
+DEFAULT_HNSW_M = 32
+DEFAULT_TRAIN_SIZE = 10000000
+DEFAULT_CHUNK_SIZE = 1000000
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', required=True,
+                    help='memory-mapped float32 embeddings file (.npy or raw) to index')
+parser.add_argument('--output', required=True,
+                    help='file to write the FAISS index to')
+parser.add_argument('--ndim', type=int, default=None,
+                    help='dimension of the embedding vectors (only needed for raw input files)')
+parser.add_argument('--index-type', choices=['ivf', 'hnsw'], default=DEFAULT_INDEX_TYPE,
+                    help='IVF index with an HNSW quantizer, or a flat HNSW graph index')
+parser.add_argument('--nlist', type=int, default=DEFAULT_NLIST,
+                    help='number of IVF clusters')
+parser.add_argument('--hnsw-m', type=int, default=DEFAULT_HNSW_M,
+                    help='number of neighbors per HNSW graph node')
+parser.add_argument('--train-size', type=int, default=DEFAULT_TRAIN_SIZE,
+                    help='number of randomly sampled vectors to train the IVF clusters on')
+parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                    help='number of vectors to add to the index at a time')
+
+
+def load_vectors(input_file, ndim=None):
+    """Return a read-only memory map of the float32 vectors in 'input_file'.
+    """
+    if input_file.endswith('.npy'):
+        return np.load(input_file, mmap_mode='r')
+    if ndim is None:
+        raise Exception('--ndim is required for raw embedding files')
+    dtype = np.float32
+    ntotal = os.path.getsize(input_file) // ndim // np.zeros(1, dtype=dtype).nbytes
+    return np.memmap(input_file, dtype=dtype, mode='r', shape=(ntotal, ndim))
+
+def normalize(vectors):
+    # zero vectors are left unchanged:
+    vectors = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return vectors / norms
+
+def build_faiss_index(vectors, index_type=DEFAULT_INDEX_TYPE, nlist=DEFAULT_NLIST, hnsw_m=DEFAULT_HNSW_M,
+                      train_size=DEFAULT_TRAIN_SIZE, chunksize=DEFAULT_CHUNK_SIZE):
+    """Build an inner product index over the unit-normalized 'vectors'.
+    """
+    ntotal, ndim = vectors.shape
+    metric = faiss.METRIC_INNER_PRODUCT
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(ndim, hnsw_m, metric)
+    else:
+        quantizer = faiss.IndexHNSWFlat(ndim, hnsw_m, metric)
+        index = faiss.IndexIVFFlat(quantizer, ndim, nlist, metric)
+        # sorted random sample, so we access the memory map sequentially:
+        sample = np.sort(np.random.default_rng(0).choice(ntotal, size=min(train_size, ntotal), replace=False))
+        sys.stderr.write(f'Training on {len(sample)} vectors...\n')
+        index.train(normalize(vectors[sample]))
+    for start in range(0, ntotal, chunksize):
+        index.add(normalize(vectors[start:start + chunksize]))
+        sys.stderr.write('.')
+        sys.stderr.flush()
+    sys.stderr.write('\n')
+    return index
+
+
+if __name__ == "__main__" and len(script_name) > 0:
+    args = parser.parse_args()
+    vectors = load_vectors(args.input, ndim=args.ndim)
+    index = build_faiss_index(vectors, index_type=args.index_type, nlist=args.nlist, hnsw_m=args.hnsw_m,
+                              train_size=args.train_size, chunksize=args.chunk_size)
+    faiss.write_index(index, args.output)
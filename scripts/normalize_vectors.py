@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# Utility to unit-normalize the vectors of a memory-mapped float32 embeddings file.
+# Similarities over the resulting file reduce to dot products, so similarity
+# computations do not have to normalize vectors on every request.  To use the
+# output, point the respective *_EMBEDDINGS config key to it and add the embedding
+# type to NORMALIZED_EMBEDDINGS.  Any FAISS index used for nearest neighbor search
+# over these embeddings needs to be built from the normalized vectors as well.
+
+import sys
+import os
+import os.path
+import numpy as np
+import argparse
+
+script_name = os.path.basename((len(sys.argv) > 0 and sys.argv[0]) or '')
+script_home = os.path.dirname((len(sys.argv) > 0 and sys.argv[0]) or '')
+
+
+### Command-line argument handling:
+
+DEFAULT_CHUNK_SIZE = 1000000
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', required=True,
+                    help='memory-mapped float32 embeddings file to normalize')
+parser.add_argument('--output', required=True,
+                    help='file to write the normalized embeddings to')
+parser.add_argument('--ndim', type=int, required=True,
+                    help='dimension of the embedding vectors')
+parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                    help='number of vectors to normalize at a time')
+
+
+def normalize_vectors(input_file, output_file, ndim, chunksize=DEFAULT_CHUNK_SIZE):
+    """Write unit-normalized versions of the float32 vectors in 'input_file' to 'output_file'.
+    Zero vectors are copied unchanged.
+    """
+    dtype = np.float32
+    ntotal = os.path.getsize(input_file) // ndim // np.zeros(1, dtype=dtype).nbytes
+    inp = np.memmap(input_file, dtype=dtype, mode='r', shape=(ntotal, ndim))
+    out = np.memmap(output_file, dtype=dtype, mode='w+', shape=(ntotal, ndim))
+    for start in range(0, ntotal, chunksize):
+        chunk = np.array(inp[start:start + chunksize])
+        norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+        norms[norms == 0.0] = 1.0
+        out[start:start + chunksize] = chunk / norms
+        sys.stderr.write('.')
+        sys.stderr.flush()
+    out.flush()
+
+
+if __name__ == "__main__" and len(script_name) > 0:
+    args = parser.parse_args()
+    normalize_vectors(args.input, args.output, args.ndim, chunksize=args.chunk_size)
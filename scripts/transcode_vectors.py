@@ -2,13 +2,17 @@
 
 # Utility to preprocess embedding vector text files into KGTK format.
 # Reads vectors from stdin and reformats them to stdout.
-
-# TO DO: generalize to support generation of numpy mmap files
+# Alternatively, with --output-format mmap or npy, vectors are written directly
+# into a float32 Numpy file plus a KGTK numids file mapping each node to its row,
+# with parsing of input chunks distributed over a pool of worker processes.
 
 import sys
 import os
 import os.path
 import base64
+import collections
+import functools
+import multiprocessing
 import numpy as np
 import csv
 import argparse
@@ -16,12 +20,20 @@ import argparse
 script_name = os.path.basename((len(sys.argv) > 0 and sys.argv[0]) or '')
 script_home = os.path.dirname((len(sys.argv) > 0 and sys.argv[0]) or '')
 
+# share the .npy writing code with the array store builds:
+sys.path.insert(0, os.path.join(script_home, '..'))
+from semantic_similarity.arrays import npy_header
+
 
 ### Command-line argument handling:
 
 DEFAULT_FORMAT = 'plain'
 DEFAULT_INPUT_LABEL = 'text_embedding'
 DEFAULT_LABEL = 'emb'
+DEFAULT_OUTPUT_FORMAT = 'kgtk'
+DEFAULT_NUMIDS_LABEL = 'numid'
+DEFAULT_CHUNK_SIZE = 100000
+DEFAULT_CHUNK_BYTES = 2 ** 24
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--format', default=DEFAULT_FORMAT,
@@ -30,6 +42,24 @@ parser.add_argument('--input-label', default=DEFAULT_INPUT_LABEL,
                     help='label value used for input embeddings')
 parser.add_argument('--label', default=DEFAULT_LABEL,
                     help='output value to use for the label column')
+parser.add_argument('--output-format', default=DEFAULT_OUTPUT_FORMAT, choices=('kgtk', 'mmap', 'npy'),
+                    help='kgtk writes base64-encoded vectors to stdout, mmap and npy write a float32 '
+                    'Numpy file (npy includes a shape/dtype header) plus a numids file')
+parser.add_argument('--output', default=None,
+                    help='vectors file to write for mmap and npy output formats')
+parser.add_argument('--numids', default=None,
+                    help='KGTK file mapping nodes to vector rows to write for mmap and npy output formats')
+parser.add_argument('--numids-label', default=DEFAULT_NUMIDS_LABEL,
+                    help='value to use for the label column of the numids file')
+parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='number of worker processes to use for parsing vectors')
+parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                    help='maximum number of input lines parsed by a worker at a time')
+parser.add_argument('--chunk-bytes', type=int, default=DEFAULT_CHUNK_BYTES,
+                    help='maximum (approximate) number of input bytes parsed by a worker at a time')
+parser.add_argument('--max-pending', type=int, default=None,
+                    help='maximum number of chunks being parsed or waiting to be written '
+                    '(default: number of workers plus 2)')
 
 
 def transcode_plain_vectors(inp, out, label=DEFAULT_LABEL):
@@ -94,12 +124,115 @@ def transcode_kgtk_vectors(inp, out, input_label=DEFAULT_INPUT_LABEL, label=DEFA
         sys.stderr.flush()
 
 
+### Direct transcoding to Numpy files:
+
+def read_chunks(inp, chunksize, chunkbytes=DEFAULT_CHUNK_BYTES):
+    # chunks are also limited by size, since lines of high-dimensional vectors can be very long:
+    chunk = []
+    nbytes = 0
+    for line in inp:
+        chunk.append(line)
+        nbytes += len(line)
+        if len(chunk) >= chunksize or nbytes >= chunkbytes:
+            yield chunk
+            chunk = []
+            nbytes = 0
+    if len(chunk) > 0:
+        yield chunk
+
+def imap_bounded(pool, func, chunks, maxpending):
+    """Like 'pool.imap' but only reads ahead 'maxpending' chunks, so memory stays bounded.
+    """
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(func, (chunk,)))
+        if len(pending) >= maxpending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def parse_plain_chunk(lines, ndim=None):
+    sep = ' '
+    nodes = []
+    vectors = np.empty((len(lines), ndim), dtype=np.float32)
+    for line in lines:
+        qnode, vec = line.split(sep, 1)
+        vectors[len(nodes)] = np.fromstring(vec, dtype=np.float32, sep=sep, count=ndim)
+        nodes.append(qnode)
+    return nodes, vectors
+
+def parse_kgtk_chunk(lines, n1col=None, lcol=None, n2col=None, input_label=DEFAULT_INPUT_LABEL):
+    sep = ','
+    nodes = []
+    vectors = []
+    for line in lines:
+        row = line.rstrip('\r\n').split('\t')
+        if row[lcol] != input_label:
+            continue
+        nodes.append(row[n1col])
+        vectors.append(np.fromstring(row[n2col], dtype=np.float32, sep=sep))
+    return nodes, np.array(vectors, dtype=np.float32)
+
+def transcode_vectors_to_numpy(inp, output, numids, format=DEFAULT_FORMAT, input_label=DEFAULT_INPUT_LABEL,
+                               output_format='npy', numids_label=DEFAULT_NUMIDS_LABEL,
+                               workers=None, chunksize=DEFAULT_CHUNK_SIZE, chunkbytes=DEFAULT_CHUNK_BYTES,
+                               maxpending=None):
+    """Stream vectors from 'inp' directly into the float32 file 'output' and write a KGTK
+    'numids' file that maps each node to its row in 'output'.  For 'npy' output format,
+    'output' will have a .npy shape/dtype header, otherwise it is a raw memory-mappable file.
+    At most 'maxpending' chunks are in memory at a time.
+    """
+    header = inp.readline()
+    if format == 'plain':
+        total, ndim = header.strip().split(' ')
+        parse_chunk = functools.partial(parse_plain_chunk, ndim=int(ndim))
+    elif format == 'kgtk':
+        header = header.rstrip('\r\n').split('\t')
+        parse_chunk = functools.partial(parse_kgtk_chunk, n1col=header.index('node1'), lcol=header.index('label'),
+                                        n2col=header.index('node2'), input_label=input_label)
+    else:
+        raise Exception(f'unsupported format: {format}')
+
+    workers = workers or os.cpu_count()
+    maxpending = maxpending or workers + 2
+    nrows = 0
+    ndim = None
+    with open(output, 'wb') as vout, open(numids, 'w') as nout, multiprocessing.Pool(workers) as pool:
+        if output_format == 'npy':
+            vout.write(npy_header((0, 0), np.float32))
+        writer = csv.writer(nout, dialect=None, delimiter='\t', quoting=csv.QUOTE_NONE, lineterminator='\n')
+        writer.writerow(['id', 'node1', 'label', 'node2'])
+        for nodes, vectors in imap_bounded(pool, parse_chunk, read_chunks(inp, chunksize, chunkbytes), maxpending):
+            if len(nodes) == 0:
+                continue
+            if ndim is None:
+                ndim = vectors.shape[1]
+            elif vectors.shape[1] != ndim:
+                raise Exception(f'inconsistent vector dimensions: {vectors.shape[1]} vs. {ndim}')
+            vout.write(vectors.tobytes())
+            writer.writerows(['e' + str(nrows + i), node, numids_label, str(nrows + i)] for i, node in enumerate(nodes))
+            nrows += len(nodes)
+            sys.stderr.write('.')
+            sys.stderr.flush()
+        if output_format == 'npy':
+            vout.seek(0)
+            vout.write(npy_header((nrows, ndim or 0), np.float32))
+    return nrows, ndim
+
+
 if __name__ == "__main__" and len(script_name) > 0:
     args = parser.parse_args()
     label = args.label
-    if args.format == 'plain':
+    if args.output_format in ('mmap', 'npy'):
+        if args.output is None or args.numids is None:
+            raise Exception(f'--output and --numids are required for output format {args.output_format}')
+        transcode_vectors_to_numpy(sys.stdin, args.output, args.numids, format=args.format,
+                                   input_label=args.input_label, output_format=args.output_format,
+                                   numids_label=args.numids_label, workers=args.workers, chunksize=args.chunk_size,
+                                   chunkbytes=args.chunk_bytes, maxpending=args.max_pending)
+    elif args.format == 'plain':
         transcode_plain_vectors(sys.stdin, sys.stdout, label=label)
     elif args.format == 'kgtk':
-        transcode_kgtk_vectors(sys.stdin, sys.stdout, label=label)
+        transcode_kgtk_vectors(sys.stdin, sys.stdout, input_label=args.input_label, label=label)
     else:
         raise Exception(f'unsupported format: {args.format}')
@@ -0,0 +1,532 @@
+"""
+Memory-mappable array structures that replace per-node Kypher queries
+with vectorized lookups.  These are built offline from the graph cache
+(see 'build_arrays.py') and stored as sets of Numpy '.npy' files that
+share a common file prefix, so they can be memory-mapped read-only.
+"""
+
+import os.path
+import json
+import struct
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def get_array_file(prefix, name):
+    return f'{prefix}.{name}.npy'
+
+def save_arrays(prefix, **arrays):
+    """Save each of the named 'arrays' to its own '<prefix>.<name>.npy' file.
+    """
+    dirname = os.path.dirname(prefix)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(get_array_file(prefix, name), array)
+
+def load_arrays(prefix, *names, mmap=True):
+    """Load the arrays 'names' saved under 'prefix' and return them as a list.
+    Arrays are memory-mapped read-only unless 'mmap' is False.  Return None
+    if any of the files do not exist.
+    """
+    files = [get_array_file(prefix, name) for name in names]
+    if not all(os.path.exists(file) for file in files):
+        return None
+    return [np.load(file, mmap_mode='r' if mmap else None) for file in files]
+
+def get_manifest_file(prefix):
+    return f'{prefix}.manifest.json'
+
+def save_manifest(prefix, manifest):
+    """Save the JSON-serializable 'manifest' describing the arrays saved under 'prefix'.
+    """
+    with open(get_manifest_file(prefix), 'w') as out:
+        json.dump(manifest, out, indent=2)
+
+def load_manifest(prefix):
+    """Load the manifest saved under 'prefix', or return None if it does not exist.
+    """
+    file = get_manifest_file(prefix)
+    if os.path.exists(file):
+        with open(file) as inp:
+            return json.load(inp)
+
+NPY_HEADER_SIZE = 128
+
+def npy_header(shape, dtype):
+    """Return a fixed-size .npy format header for a C-order array of 'shape' and 'dtype'.
+    Using a fixed size allows us to write a placeholder first and the real shape at the end.
+    """
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)})
+    magic = b'\x93NUMPY\x01\x00'
+    header_len = NPY_HEADER_SIZE - len(magic) - 2
+    header = header.ljust(header_len - 1) + '\n'
+    return magic + struct.pack('<H', header_len) + header.encode('latin1')
+
+class NpyWriter(object):
+    """Incrementally write a 1-dim array of unknown length to a .npy file.
+    A fixed-size header is written first and updated with the final length on 'close'.
+    """
+
+    def __init__(self, file, dtype):
+        self.file = open(file, 'wb')
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.file.write(self.get_header())
+
+    def get_header(self):
+        return npy_header((self.length,), self.dtype)
+
+    def append(self, array):
+        array = np.asarray(array, dtype=self.dtype)
+        self.file.write(array.tobytes())
+        self.length += len(array)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self.get_header())
+        self.file.close()
+
+def csr_gather(indptr, indices, rows):
+    """Gather the CSR rows 'rows' given by 'indptr' and 'indices' in a single vectorized step.
+    Return the 'indptr' and 'indices' arrays of the resulting sub matrix.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    sub_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=sub_indptr[1:])
+    offsets = np.arange(sub_indptr[-1], dtype=np.int64) + np.repeat(starts - sub_indptr[:-1], lengths)
+    return sub_indptr, np.asarray(indices[offsets])
+
+def build_csr(sources, targets, nrows):
+    """Build a CSR adjacency structure with 'nrows' rows from the parallel integer arrays
+    'sources' and 'targets'.  Each row lists its unique targets in sorted order.
+    Return the 'indptr' and 'indices' arrays of the resulting structure.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    order = np.lexsort((targets, sources))
+    sources, targets = sources[order], targets[order]
+    if len(sources) > 0:
+        unique = np.ones(len(sources), dtype=bool)
+        unique[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        sources, targets = sources[unique], targets[unique]
+    indptr = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=nrows), out=indptr[1:])
+    return indptr, targets.astype(np.int32)
+
+def encode_nodes(nodes):
+    """Encode the node name strings 'nodes' into a fixed-width bytes array.
+    """
+    return np.array([node.encode('utf8') for node in nodes], dtype=np.bytes_)
+
+def encode_node_columns(rows, ncolumns, chunksize=1000000):
+    """Encode the first 'ncolumns' columns of the node name string tuples 'rows' into
+    one fixed-width bytes array per column.  This works in chunks to bound the amount
+    of memory needed for intermediate Python strings when scanning large graphs.
+    """
+    columns = [[] for i in range(ncolumns)]
+    chunk = []
+    def flush():
+        for i, column in enumerate(zip(*chunk)):
+            if i < ncolumns:
+                columns[i].append(encode_nodes(column))
+        chunk.clear()
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunksize:
+            flush()
+    if chunk:
+        flush()
+    return [np.concatenate(column) if column else np.array([], dtype=np.bytes_) for column in columns]
+
+
+class NodeKeys(object):
+    """Sorted fixed-width bytes array of node names.  Supports vectorized lookup
+    of the positions of a sequence of node names via binary search, as well
+    as the reverse mapping from positions to node names.  The node intern table
+    shared by all array structures is an instance of this, where the position
+    of a node in the table is its interned node id.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """Create a key table from the sequence of node name strings 'nodes'.
+        Return the table and a permutation 'order' such that 'keys[i] == nodes[order[i]]'.
+        """
+        keys = encode_nodes(nodes)
+        order = np.argsort(keys, kind='stable')
+        return cls(keys[order]), order
+
+    @classmethod
+    def load(cls, prefix):
+        """Load a memory-mapped key table saved under 'prefix', or return None if it does not exist.
+        """
+        arrays = load_arrays(prefix, 'keys')
+        return arrays and cls(arrays[0])
+
+    def save(self, prefix):
+        save_arrays(prefix, keys=self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, nodes):
+        """Return an int64 array with the positions of 'nodes' in this table
+        and -1 for any nodes that are not in the table.
+        """
+        return self.lookup_encoded(encode_nodes(nodes))
+
+    def lookup_encoded(self, query):
+        """Same as 'lookup' but for a bytes array of already encoded node names.
+        """
+        if len(query) == 0 or len(self.keys) == 0:
+            return np.full(len(query), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        return np.where(self.keys[positions] == query, positions, -1)
+
+    def get_nodes(self, positions):
+        """Return the list of node names at 'positions' (which must all be valid).
+        """
+        return [key.decode('utf8') for key in self.keys[np.asarray(positions, dtype=np.int64)]]
+
+
+class NodeRowIndex(object):
+    """Maps interned node ids onto integer rows, for example, the rows of a memory-mapped
+    embedding matrix.  Rows are stored in a dense int32 array indexed by node id with -1
+    for nodes without a row.  This replaces one numids query per node with a single
+    vectorized lookup for a whole batch of nodes.  The reverse mapping from rows back
+    onto node ids is stored in a second dense int32 array indexed by row, which decodes
+    a batch of rows such as nearest neighbor search results with a single gather.
+    """
+
+    def __init__(self, interns, rows, row_ids=None):
+        self.interns = interns
+        self.rows = rows
+        self.row_ids = row_ids
+
+    @classmethod
+    def build(cls, interns, nodes, rows):
+        """Build an index that maps each of 'nodes' onto its respective element of 'rows'
+        and back.  Nodes that are not in the 'interns' table are ignored.
+        """
+        ids = interns.lookup(nodes)
+        found = ids >= 0
+        rows = np.asarray(rows, dtype=np.int32)
+        dense_rows = np.full(len(interns), -1, dtype=np.int32)
+        dense_rows[ids[found]] = rows[found]
+        row_ids = np.full(int(rows.max()) + 1 if len(rows) > 0 else 0, -1, dtype=np.int32)
+        row_ids[rows[found]] = ids[found]
+        return cls(interns, dense_rows, row_ids)
+
+    @classmethod
+    def load(cls, prefix, interns):
+        """Load a memory-mapped index saved under 'prefix', or return None if it does
+        not exist or was not built for the current 'interns' table.  Indexes saved
+        without the reverse mapping are loaded with 'row_ids' set to None.
+        """
+        arrays = load_arrays(prefix, 'rows')
+        if arrays and len(arrays[0]) == len(interns):
+            row_ids = load_arrays(prefix, 'ids')
+            return cls(interns, arrays[0], row_ids and row_ids[0])
+
+    def save(self, prefix):
+        if self.row_ids is not None:
+            save_arrays(prefix, rows=self.rows, ids=self.row_ids)
+        else:
+            save_arrays(prefix, rows=self.rows)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.rows >= 0))
+
+    def lookup(self, nodes):
+        """Return an int64 array with the rows of 'nodes' and -1 for unknown nodes.
+        """
+        return self.lookup_ids(self.interns.lookup(nodes))
+
+    def lookup_ids(self, ids):
+        """Return an int64 array with the rows of the node 'ids' and -1 for unknown nodes.
+        """
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        found = ids >= 0
+        rows[found] = self.rows[ids[found]]
+        return rows
+
+    def has_row_ids(self):
+        return self.row_ids is not None
+
+    def lookup_rows(self, rows):
+        """Return an int64 array with the node ids of 'rows' and -1 for unknown rows.
+        This requires the reverse mapping to be available.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        ids = np.full(len(rows), -1, dtype=np.int64)
+        found = (rows >= 0) & (rows < len(self.row_ids))
+        ids[found] = self.row_ids[rows[found]]
+        return ids
+
+    def get_row_nodes(self, rows):
+        """Return a list with the node names of 'rows' and None for unknown rows.
+        """
+        ids = self.lookup_rows(rows)
+        found = ids >= 0
+        nodes = [None] * len(ids)
+        for i, node in zip(np.flatnonzero(found), self.interns.get_nodes(ids[found])):
+            nodes[i] = node
+        return nodes
+
+
+class NodeCounts(object):
+    """Maps interned node ids onto counts, for example, the transitive instance counts
+    of classes.  Counts are stored in a dense int64 array indexed by node id with -1
+    for nodes without a count.  This replaces one count query per node with a single
+    vectorized lookup for a whole batch of nodes.
+    """
+
+    def __init__(self, interns, counts):
+        self.interns = interns
+        self.counts = counts
+
+    @classmethod
+    def build(cls, interns, nodes, counts):
+        """Build a table that maps each of 'nodes' onto its respective element of 'counts'.
+        Nodes that are not in the 'interns' table are ignored.
+        """
+        ids = interns.lookup(nodes)
+        found = ids >= 0
+        dense_counts = np.full(len(interns), -1, dtype=np.int64)
+        dense_counts[ids[found]] = np.asarray(counts, dtype=np.int64)[found]
+        return cls(interns, dense_counts)
+
+    @classmethod
+    def load(cls, prefix, interns):
+        """Load a memory-mapped table saved under 'prefix', or return None if it does
+        not exist or was not built for the current 'interns' table.
+        """
+        arrays = load_arrays(prefix, 'counts')
+        if arrays and len(arrays[0]) == len(interns):
+            return cls(interns, arrays[0])
+
+    def save(self, prefix):
+        save_arrays(prefix, counts=self.counts)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts >= 0))
+
+    def lookup(self, nodes, dflt=0):
+        """Return an array with the counts of 'nodes' and 'dflt' for unknown nodes.
+        """
+        ids = self.interns.lookup(nodes)
+        counts = np.full(len(ids), dflt, dtype=np.result_type(self.counts.dtype, type(dflt)))
+        found = np.flatnonzero(ids >= 0)
+        found_counts = self.counts[ids[found]]
+        counts[found[found_counts >= 0]] = found_counts[found_counts >= 0]
+        return counts
+
+
+class NodeLabels(object):
+    """Maps interned node ids onto label strings.  The UTF-8 encoded labels are stored
+    back-to-back in a single uint8 blob, together with dense int64 offset and int32 length
+    arrays indexed by node id, where an offset of -1 marks nodes without a label.  This
+    replaces one label query per node with direct slicing of a memory-mapped blob.
+    """
+
+    def __init__(self, interns, offsets, lengths, data):
+        self.interns = interns
+        self.offsets = offsets
+        self.lengths = lengths
+        self.data = data
+
+    @classmethod
+    def build(cls, interns, rows, prefix, chunksize=1000000):
+        """Build a label table from the (node, label) tuples 'rows' and save it under 'prefix'.
+        Labels are written to the blob incrementally, so 'rows' can be a large query result.
+        Nodes that are not in the 'interns' table are ignored, and only the first label of
+        each node is used.  Return the loaded table.
+        """
+        writer = NpyWriter(get_array_file(prefix, 'data'), np.uint8)
+        all_ids, all_offsets, all_lengths = [], [], []
+        chunk = []
+        def flush():
+            nodes, labels = zip(*chunk)
+            ids = interns.lookup(nodes)
+            found = np.flatnonzero(ids >= 0)
+            encoded = [labels[i].encode('utf8') for i in found]
+            lengths = np.array([len(label) for label in encoded], dtype=np.int64)
+            offsets = writer.length + np.cumsum(lengths) - lengths
+            writer.append(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            all_ids.append(ids[found])
+            all_offsets.append(offsets)
+            all_lengths.append(lengths)
+            chunk.clear()
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunksize:
+                flush()
+        if chunk:
+            flush()
+        writer.close()
+        ids = np.concatenate(all_ids) if all_ids else np.array([], dtype=np.int64)
+        ids, first = np.unique(ids, return_index=True)
+        dense_offsets = np.full(len(interns), -1, dtype=np.int64)
+        dense_lengths = np.zeros(len(interns), dtype=np.int32)
+        if len(ids) > 0:
+            dense_offsets[ids] = np.concatenate(all_offsets)[first]
+            dense_lengths[ids] = np.concatenate(all_lengths)[first]
+        save_arrays(prefix, offsets=dense_offsets, lengths=dense_lengths)
+        return cls.load(prefix, interns)
+
+    @classmethod
+    def load(cls, prefix, interns):
+        """Load a memory-mapped table saved under 'prefix', or return None if it does
+        not exist or was not built for the current 'interns' table.
+        """
+        arrays = load_arrays(prefix, 'offsets', 'lengths', 'data')
+        if arrays and len(arrays[0]) == len(interns):
+            return cls(interns, *arrays)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.offsets >= 0))
+
+    def lookup_ids(self, ids):
+        """Return a list with the labels of the node 'ids' and None for nodes without a label.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        labels = [None] * len(ids)
+        found = np.flatnonzero(ids >= 0)
+        offsets = self.offsets[ids[found]]
+        lengths = self.lengths[ids[found]]
+        data = self.data
+        for i, offset, length in zip(found, offsets, lengths):
+            if offset >= 0:
+                labels[i] = bytes(data[offset:offset + length]).decode('utf8')
+        return labels
+
+    def lookup(self, nodes):
+        """Return a list with the labels of 'nodes' and None for unknown nodes or nodes without a label.
+        """
+        return self.lookup_ids(self.interns.lookup(nodes))
+
+
+class ClassFeatureMatrix(object):
+    """Binary sparse matrix in CSR format mapping nodes onto the set of their classes
+    (all transitive super classes plus the node itself) together with a dense vector
+    of log-IDF weights per class column and the per-node sums of these weights.
+    With this, the normalized IDF class similarity of two nodes with class sets A and B
+    is 2*idf(A & B) / (idf(A) + idf(B)), where idf(X) is the sum of the weights of X.
+    """
+
+    def __init__(self, index, indptr, indices, idf, weights):
+        self.index = index
+        self.indptr = indptr
+        self.indices = indices
+        self.idf = idf
+        self.weights = weights
+
+    @classmethod
+    def load(cls, prefix, interns):
+        """Load a memory-mapped matrix saved under 'prefix', or return None if it does
+        not exist or was not built for the current 'interns' table.
+        """
+        index = NodeRowIndex.load(prefix, interns)
+        arrays = index and load_arrays(prefix, 'indptr', 'indices', 'idf', 'weights')
+        return arrays and cls(index, *arrays)
+
+    def get_rows(self, nodes):
+        return self.index.lookup(nodes)
+
+    def pairwise_similarities(self, rows1, rows2):
+        """Compute class similarities for the row pairs 'rows1[i]' and 'rows2[i]' and return them
+        as a float64 array.  Negative rows mark nodes without classes whose similarity is 0.0.
+        """
+        rows1 = np.asarray(rows1, dtype=np.int64)
+        rows2 = np.asarray(rows2, dtype=np.int64)
+        sims = np.zeros(len(rows1), dtype=np.float64)
+        valid = np.flatnonzero((rows1 >= 0) & (rows2 >= 0))
+        if len(valid) == 0:
+            return sims
+        rows1, rows2 = rows1[valid], rows2[valid]
+        indptr1, indices1 = csr_gather(self.indptr, self.indices, rows1)
+        indptr2, indices2 = csr_gather(self.indptr, self.indices, rows2)
+        # restrict the class columns to the ones occurring in this batch:
+        columns, local = np.unique(np.concatenate([indices1, indices2]), return_inverse=True)
+        shape = (len(valid), len(columns))
+        x = sp.csr_matrix((np.ones(len(indices1)), local[:len(indices1)], indptr1), shape=shape)
+        y = sp.csr_matrix((np.ones(len(indices2)), local[len(indices1):], indptr2), shape=shape)
+        common = np.asarray(x.multiply(y) @ np.asarray(self.idf[columns], dtype=np.float64)).ravel()
+        total = np.asarray(self.weights[rows1], dtype=np.float64) + np.asarray(self.weights[rows2], dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pair_sims = np.where(total > 0.0, 2.0 * common / total, 0.0)
+        # avoid rounding differences for identical nodes:
+        pair_sims[(rows1 == rows2) & (total > 0.0)] = 1.0
+        sims[valid] = pair_sims
+        return sims
+
+
+class ClassAncestors(object):
+    """Compact ancestor structure of the class hierarchy used to compute most specific
+    subsumers.  Three CSR structures over interned node ids store the direct P31/P279 parents of each node, the
+    direct P279 parents of each node, and the P279* closure of each class.
+    """
+
+    def __init__(self, interns, isa_indptr, isa_indices, parent_indptr, parent_indices, star_indptr, star_indices):
+        self.interns = interns
+        self.isa = (isa_indptr, isa_indices)
+        self.parents = (parent_indptr, parent_indices)
+        self.star = (star_indptr, star_indices)
+
+    ARRAY_NAMES = ('isa_indptr', 'isa_indices', 'parent_indptr', 'parent_indices', 'star_indptr', 'star_indices')
+
+    @classmethod
+    def load(cls, prefix, interns):
+        """Load a memory-mapped structure saved under 'prefix', or return None if it does
+        not exist or was not built for the current 'interns' table.
+        """
+        arrays = load_arrays(prefix, *cls.ARRAY_NAMES)
+        if arrays and len(arrays[0]) == len(interns) + 1:
+            return cls(interns, *arrays)
+
+    def save(self, prefix):
+        save_arrays(prefix, **dict(zip(self.ARRAY_NAMES, self.isa + self.parents + self.star)))
+
+    def __len__(self):
+        # the number of nodes that have any P31/P279 parents:
+        return int(np.count_nonzero(np.diff(self.isa[0])))
+
+    def get_supers(self, node_id):
+        """Return the sorted supers of 'node_id' (which include the node itself if it has any
+        parents), its proper supers reachable from its parents via P279*, and its parents.
+        """
+        isa = csr_gather(*self.isa, [node_id])[1]
+        if len(isa) == 0:
+            return isa, isa, isa
+        proper = np.unique(csr_gather(*self.star, isa)[1])
+        return np.union1d(proper, [node_id]), proper, isa
+
+    def most_specific_subsumers(self, c1, c2):
+        """Compute the set of most specific subsumers of 'c1' and 'c2' equivalent to
+        'SimilarityBackend.most_specific_subsumers' via a few sorted array set operations.
+        """
+        id1, id2 = self.interns.lookup([c1, c2])
+        if id1 < 0 or id2 < 0:
+            return set()
+        supers1, proper1, isa1 = self.get_supers(id1)
+        supers2, proper2, isa2 = self.get_supers(id2)
+        # mss has to be in the intersection of superclasses:
+        common = np.intersect1d(supers1, supers2, assume_unique=True)
+        if len(common) == 0:
+            return set()
+        # now exclude the direct parents of each candidate in common, where the nodes themselves
+        # might also be linked to their parents by P31, while the proper supers only use P279:
+        exclude = [csr_gather(*self.parents, np.intersect1d(common, np.union1d(proper1, proper2)))[1]]
+        if id1 in common:
+            exclude.append(isa1)
+        if id2 in common:
+            exclude.append(isa2)
+        mss = np.setdiff1d(common, np.concatenate(exclude))
+        return set(self.interns.get_nodes(mss))
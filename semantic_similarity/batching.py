@@ -0,0 +1,66 @@
+"""
+Cross-request micro-batching of single-pair similarity computations.
+"""
+
+import time
+import queue
+import threading
+from   concurrent.futures import Future
+
+
+class MicroBatcher(object):
+    """Collects concurrent single-pair similarity requests for one similarity 'measure'
+    for up to 'max_wait' seconds (or until 'max_batch' requests have been collected)
+    and computes them all with a single call to its bulk 'compute_pairwise_similarities'
+    method.  Requesting threads block until the batch containing their pair is done.
+    """
+
+    def __init__(self, measure, max_wait=0.005, max_batch=1000):
+        self.measure = measure
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.collector = None
+        self.lock = threading.Lock()
+
+    def compute_similarity(self, c1, c2):
+        future = Future()
+        self.requests.put(((c1, c2), future))
+        self.ensure_collector()
+        return future.result()
+
+    def ensure_collector(self):
+        # we start the collector lazily, so it also gets restarted in forked worker processes:
+        if self.collector is None or not self.collector.is_alive():
+            with self.lock:
+                if self.collector is None or not self.collector.is_alive():
+                    self.collector = threading.Thread(target=self.collect, daemon=True)
+                    self.collector.start()
+
+    def collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def collect(self):
+        while True:
+            batch = self.collect_batch()
+            try:
+                similarities = list(self.measure.compute_pairwise_similarities([pair for pair, future in batch]))
+                if len(similarities) != len(batch):
+                    raise Exception(f'expected {len(batch)} similarities but got {len(similarities)}')
+                for (pair, future), sim in zip(batch, similarities):
+                    future.set_result(sim)
+            except Exception as e:
+                # some futures might already have their result, but none may be left waiting:
+                for pair, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
@@ -0,0 +1,100 @@
+"""
+Build the precomputed memory-mappable array structures used by the similarity
+backend from the configured graph cache and save them to the 'ARRAY_STORE'.
+This needs to be run once per graph cache version from the repository root,
+since that is where the configuration gets loaded from, for example:
+
+    python -m semantic_similarity.build_arrays --node-interns --embedding-row-indexes complex transe text
+"""
+
+import sys
+import argparse
+
+import semantic_similarity.kypher as kypher
+
+
+parser = argparse.ArgumentParser(prog='python -m semantic_similarity.build_arrays')
+parser.add_argument('--node-interns', action='store_true',
+                    help='build the node intern table shared by all other array structures, '
+                    'which need to be rebuilt whenever this is rebuilt')
+parser.add_argument('--embedding-row-indexes', nargs='*', metavar='TYPE',
+                    choices=list(kypher.SimilarityBackend.EMBEDDING_TYPES.keys()) + ['node2vec'],
+                    help='build node-to-row and row-to-node indexes for these embedding types '
+                    '(node2vec is only indexed if requested explicitly)')
+parser.add_argument('--embedding-norms', nargs='*', metavar='TYPE',
+                    choices=list(kypher.SimilarityBackend.EMBEDDING_TYPES.keys()),
+                    help='precompute row norms for these (unnormalized) embedding types')
+parser.add_argument('--class-features', action='store_true',
+                    help='build the sparse node-to-classes matrix used for class similarity')
+parser.add_argument('--class-ancestors', action='store_true',
+                    help='build the class ancestor structure used for most specific subsumers')
+parser.add_argument('--class-counts', action='store_true',
+                    help='build the class count table')
+parser.add_argument('--labels', action='store_true',
+                    help='build the table of normalized node labels in the configured DEFAULT_LANGUAGE')
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+def build_node_interns(backend):
+    log('Building node interns...')
+    interns = backend.build_node_interns()
+    log(f'Interned {len(interns)} nodes')
+
+def build_embedding_row_indexes(backend, embedding_types):
+    for embedding_type in embedding_types:
+        log(f'Building {embedding_type} embedding row index...')
+        index = backend.build_embedding_row_index(embedding_type)
+        log(f'Indexed {len(index)} {embedding_type} embedding rows')
+
+def build_embedding_norms(backend, embedding_types):
+    for embedding_type in embedding_types:
+        if backend.is_normalized_embeddings(embedding_type):
+            log(f'Skipping norms for normalized {embedding_type} embeddings')
+            continue
+        log(f'Computing {embedding_type} embedding norms...')
+        norms = backend.build_embedding_norms(embedding_type)
+        log(f'Computed {len(norms)} {embedding_type} embedding norms')
+
+def build_class_feature_matrix(backend):
+    log('Building class feature matrix...')
+    matrix = backend.build_class_feature_matrix()
+    log(f'Built class feature matrix with {len(matrix.index)} rows, {len(matrix.idf)} columns and {len(matrix.indices)} entries')
+
+def build_class_ancestors(backend):
+    log('Building class ancestors...')
+    ancestors = backend.build_class_ancestors()
+    log(f'Built class ancestors for {len(ancestors)} nodes')
+
+def build_class_count_table(backend):
+    log('Building class count table...')
+    table = backend.build_class_count_table()
+    log(f'Built class count table with {len(table)} classes')
+
+def build_node_label_store(backend):
+    log('Building node label table...')
+    labels = backend.build_node_label_store()
+    log(f'Built node label table with {len(labels)} labels')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    backend = kypher.get_backend()
+    if backend.get_config('ARRAY_STORE') is None:
+        raise Exception('no ARRAY_STORE has been configured')
+    if args.node_interns:
+        build_node_interns(backend)
+    if args.embedding_row_indexes is not None:
+        build_embedding_row_indexes(backend, args.embedding_row_indexes or backend.EMBEDDING_TYPES.keys())
+    if args.embedding_norms is not None:
+        build_embedding_norms(backend, args.embedding_norms or backend.EMBEDDING_TYPES.keys())
+    if args.class_features:
+        build_class_feature_matrix(backend)
+    if args.class_ancestors:
+        build_class_ancestors(backend)
+    if args.class_counts:
+        build_class_count_table(backend)
+    if args.labels:
+        build_node_label_store(backend)
@@ -0,0 +1,134 @@
+"""
+Check the precomputed array structures against the graph cache queries they
+replace on a tiny test graph.  This builds a temporary graph cache and array
+store from a handful of P31/P279 edges, runs all class-related array builds
+just like 'build_arrays' does, and compares most specific subsumers, class
+counts and labels of all test nodes with the query-based versions.  This needs
+to be run from the repository root, since that is where the configuration gets
+loaded from:
+
+    python -m semantic_similarity.check_arrays
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import itertools
+
+import semantic_similarity.kypher as kypher
+import semantic_similarity.build_arrays as build_arrays
+
+
+parser = argparse.ArgumentParser(prog='python -m semantic_similarity.check_arrays')
+parser.add_argument('--keep', action='store_true',
+                    help='keep the temporary graph cache and array store for inspection')
+
+# instances Q1-Q3 and class hierarchy C1,C2 -> C3 -> C4, where Q4 is a subclass of C1 and
+# Q1 also has a direct P279 parent, so we cover mixed P31/P279 chains and nodes being
+# parents of each other; Q5 is an isolated node without any classes:
+TEST_EDGES = [
+    ('Q1', 'P31', 'C1'), ('Q1', 'P279', 'C2'), ('Q2', 'P31', 'C2'), ('Q3', 'P31', 'C3'),
+    ('Q4', 'P279', 'C1'), ('C1', 'P279', 'C3'), ('C2', 'P279', 'C3'), ('C3', 'P279', 'C4'),
+    ('Q1', 'P17', 'Q2'), ('Q5', 'P17', 'Q3'),
+]
+TEST_P279STAR = [
+    ('Q1', 'Q1'), ('Q1', 'C2'), ('Q1', 'C3'), ('Q1', 'C4'),
+    ('Q4', 'Q4'), ('Q4', 'C1'), ('Q4', 'C3'), ('Q4', 'C4'),
+    ('C1', 'C1'), ('C1', 'C3'), ('C1', 'C4'), ('C2', 'C2'), ('C2', 'C3'), ('C2', 'C4'),
+    ('C3', 'C3'), ('C3', 'C4'), ('C4', 'C4'),
+]
+TEST_CLASS_COUNTS = [('C1', '2'), ('C2', '2'), ('C3', '4'), ('C4', '10'), ('Q1', '1'), ('Q4', '1')]
+TEST_CLASS_COUNTS_COMPACT = [
+    ('Q1', 'C1:2|C2:2|C3:4|C4:10'), ('Q2', 'C2:2|C3:4|C4:10'), ('Q3', 'C3:4|C4:10'), ('Q4', 'C1:2|C3:4|C4:10'),
+]
+TEST_LABELS = [('Q1', "'one'@en"), ('Q2', "'two'@en"), ('Q2', "'deux'@fr"), ('C3', "'class \\'three\\''@en")]
+TEST_NODES = ['Q1', 'Q2', 'Q3', 'Q4', 'Q5', 'C1', 'C2', 'C3', 'C4', 'Q0-nonexistent']
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+def write_graph(file, label, edges):
+    with open(file, 'w') as out:
+        out.write('id\tnode1\tlabel\tnode2\n')
+        for i, edge in enumerate(edges):
+            node1, node2 = (edge[0], edge[2]) if len(edge) == 3 else edge
+            edge_label = edge[1] if len(edge) == 3 else label
+            out.write(f'e{i}\t{node1}\t{edge_label}\t{node2}\n')
+    return file
+
+def get_test_backend(directory):
+    """Create a backend for the test graph files and array store in 'directory'.
+    """
+    config = dict(kypher.BACKEND_CONFIG)
+    config.update({
+        'API_VERSION': '2',
+        'GRAPH_CACHE': os.path.join(directory, 'test.sqlite3.db'),
+        'DEFAULT_LANGUAGE': 'en',
+        'KG_EDGES_GRAPH': write_graph(os.path.join(directory, 'claims.tsv'), None, TEST_EDGES),
+        'KG_LABELS_GRAPH': write_graph(os.path.join(directory, 'labels.tsv'), 'label', TEST_LABELS),
+        'KG_P279STAR_GRAPH': write_graph(os.path.join(directory, 'p279star.tsv'), 'P279star', TEST_P279STAR),
+        'KG_CLASS_COUNTS_GRAPH': write_graph(os.path.join(directory, 'classcounts.tsv'), 'count', TEST_CLASS_COUNTS),
+        'KG_CLASS_COUNTS_COMPACT_GRAPH': write_graph(os.path.join(directory, 'classcounts_compact.tsv'),
+                                                     'class_count', TEST_CLASS_COUNTS_COMPACT),
+        'KG_NODE2VEC_EMB_NUMIDS_GRAPH': None,
+        'KG_COMPLEX_EMB_NUMIDS_GRAPH': None,
+        'KG_TRANSE_EMB_NUMIDS_GRAPH': None,
+        'KG_TEXT_EMB_NUMIDS_GRAPH': None,
+        'KG_NODE_INFO_GRAPH': None,
+        'ARRAY_STORE': os.path.join(directory, 'arrays'),
+    })
+    os.makedirs(config['ARRAY_STORE'])
+    return kypher.SimilarityBackend(config=config)
+
+def compare(name, expected, actual):
+    """Log and return the number of keys whose 'actual' array-based value differs from 'expected'.
+    """
+    errors = 0
+    for key in expected:
+        if expected[key] != actual[key]:
+            log(f'{name}: {key}: arrays {actual[key]!r} != queries {expected[key]!r}')
+            errors += 1
+    log(f'{name}: {"FAILED" if errors else "OK"}')
+    return errors
+
+def check_arrays(backend, nodes=TEST_NODES):
+    # compute all query-based results first, which imports all test graphs into the graph
+    # cache, so its version doesn't change anymore once the array store has been built:
+    pairs = list(itertools.combinations_with_replacement(nodes, 2))
+    expected_mss = {pair: set(backend.most_specific_subsumers_via_kypher(*pair)) for pair in pairs}
+    class_counts = backend.get_class_count_batch(nodes)
+    expected_counts = {node: class_counts.get(node, 0) for node in nodes}
+    expected_labels = {node: kypher.normalize_label(label) for node, label in backend.get_node_label_batch(nodes).items()}
+
+    build_arrays.build_node_interns(backend)
+    build_arrays.build_class_feature_matrix(backend)
+    build_arrays.build_class_ancestors(backend)
+    build_arrays.build_class_count_table(backend)
+    build_arrays.build_node_label_store(backend)
+
+    errors = 0
+    ancestors = backend.get_class_ancestors()
+    errors += compare('most_specific_subsumers', expected_mss,
+                      {pair: set(ancestors.most_specific_subsumers(*pair)) for pair in pairs})
+    errors += compare('class counts', expected_counts,
+                      dict(zip(nodes, backend.get_class_count_table().lookup(nodes, dflt=0).tolist())))
+    labels, missing = backend.lookup_stored_node_labels(nodes)
+    errors += compare('labels', expected_labels, {node: labels.get(node) for node in expected_labels})
+    return errors
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='kgtk-similarity-check-')
+    try:
+        errors = check_arrays(get_test_backend(directory))
+    finally:
+        if args.keep:
+            log(f'Kept test data in {directory}')
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,71 @@
+"""
+Check the batched node list accessors of the similarity backend against their
+single-node counterparts on the configured graph cache.  Node lists are padded
+to the next power of two, so the default nodes (which include a nonexistent one)
+also exercise the padding.  This needs to be run from the repository root,
+since that is where the configuration gets loaded from, for example:
+
+    python -m semantic_similarity.check_queries --nodes Q30 Q5 Q42 Q146
+"""
+
+import sys
+import argparse
+
+import semantic_similarity.kypher as kypher
+
+
+DEFAULT_NODES = ['Q30', 'Q5', 'Q42', 'Q146', 'Q35120', 'Q515', 'Q0-nonexistent']
+
+parser = argparse.ArgumentParser(prog='python -m semantic_similarity.check_queries')
+parser.add_argument('--nodes', nargs='+', metavar='NODE', default=DEFAULT_NODES,
+                    help='nodes to check the batched accessors on')
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+def compare(name, batched, single):
+    """Log and return the number of nodes whose 'batched' result differs from 'single'.
+    """
+    errors = 0
+    for node in sorted(set(batched.keys()).union(single.keys())):
+        if batched.get(node) != single.get(node):
+            log(f'{name}: {node}: batched {batched.get(node)!r} != single {single.get(node)!r}')
+            errors += 1
+    log(f'{name}: {"FAILED" if errors else "OK"}')
+    return errors
+
+def first_row(rows):
+    for row in rows:
+        return tuple(row)
+    return None
+
+def check_node_list_queries(backend, nodes):
+    errors = 0
+    errors += compare('get_node_label_batch', backend.get_node_label_batch(nodes),
+                      {node: label for node in nodes for label in [backend.get_node_label(node)] if label is not None})
+    if backend.get_config('KG_CLASS_COUNTS_GRAPH') is not None:
+        errors += compare('get_class_count_batch', backend.get_class_count_batch(nodes),
+                          {node: count for node in nodes for count in [backend.get_class_count(node, None)] if count is not None})
+    if backend.get_config('KG_CLASS_COUNTS_COMPACT_GRAPH') is not None:
+        errors += compare('get_class_counts_compact_batch', backend.get_class_counts_compact_batch(nodes),
+                          {node: counts for node in nodes for counts in [backend.get_class_counts_compact(node)] if counts is not None})
+    batched = {node: sorted(tuple(row) for row in rows) for node, rows in backend.get_node_direct_supers_batch(nodes).items()}
+    single = {node: sorted(tuple(row) for row in backend.get_node_direct_supers(node)) for node in nodes}
+    errors += compare('get_node_direct_supers_batch', batched, {node: rows for node, rows in single.items() if rows})
+    for embedding_type in list(backend.EMBEDDING_TYPES.keys()) + ['node2vec']:
+        if embedding_type == 'node2vec' and backend.get_config('KG_NODE2VEC_EMB_NUMIDS_GRAPH') is None:
+            continue
+        get_numid_and_label = getattr(backend, f'get_node_{embedding_type}_emb_numid_and_label')
+        single = {node: first_row(get_numid_and_label(node)) for node in nodes}
+        errors += compare(f'get_node_emb_numid_and_label_batch({embedding_type})',
+                          backend.get_node_emb_numid_and_label_batch(nodes, embedding_type),
+                          {node: row[1:] for node, row in single.items() if row is not None})
+    return errors
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    errors = check_node_list_queries(kypher.get_backend(), args.nodes)
+    sys.exit(1 if errors else 0)
@@ -1,5 +1,6 @@
 import faiss
 import json
+import numpy as np
 
 from semantic_similarity.utility import Utility
 import semantic_similarity.kypher as kypher
@@ -9,56 +10,94 @@ config = json.load(open('semantic_similarity/config.json'))
 
 class FAISS_Index(object):
 
-    # make the actual index objects a singleton, so we don't load them multiple times:
-    _index = None
+    # registry of the actual index objects per embedding type, so we don't load them multiple times:
+    _indexes = {}
     _qnode_to_index = None
     _index_to_qnode = None
 
+    # embedding type -> index file config key:
+    INDEX_CONFIG_KEYS = {
+        'complex': 'COMPLEX_EMB_FAISS_INDEX',
+        'transe':  'TRANSE_EMB_FAISS_INDEX',
+        'text':    'TEXT_EMB_FAISS_INDEX',
+    }
+
     DEFAULT_INDEX_NPROBE = 64
     DEFAULT_INDEX_HNSW_SEARCH_DEPTH = 128
 
-    def __init__(self, efSearch: int = None, nprobe: int = None):
+    def __init__(self, embedding_type: str = 'complex', efSearch: int = None, nprobe: int = None):
         self.config = config
         self.util = Utility()
         self.api_version_1 = self.util.api_version_1
         self.backend = kypher.get_synced_backend()
+        self.embedding_type = embedding_type
 
         efSearch = efSearch or 400 if self.api_version_1 else self.DEFAULT_INDEX_HNSW_SEARCH_DEPTH
         nprobe = nprobe or 8 if self.api_version_1 else self.DEFAULT_INDEX_NPROBE
 
-        # TO DO: make this a constructor parameter, since eventually we'll have multiple indexes:
-        index_file = config['faiss_index_file'] if self.api_version_1 else config.get("COMPLEX_EMB_FAISS_INDEX")
-        if self._index is None and index_file:
-            print('Loading FAISS index...')
-            FAISS_Index._index = faiss.read_index(index_file)
+        index_file = self.get_index_file(embedding_type)
+        if embedding_type not in self._indexes and index_file:
+            if self.config.get('faiss_search_threads'):
+                # batched searches are parallelized over queries with this many threads:
+                faiss.omp_set_num_threads(self.config['faiss_search_threads'])
+            print(f'Loading {embedding_type} FAISS index...')
+            index = self.read_index(index_file)
             try:
                 # Set the parameters
-                faiss.downcast_index(self._index.quantizer).hnsw.efSearch = efSearch
-                self._index.nprobe = nprobe
+                if hasattr(index, 'hnsw'):
+                    # flat HNSW index as built by 'scripts/build_faiss_index.py --index-type hnsw':
+                    index.hnsw.efSearch = efSearch
+                else:
+                    faiss.downcast_index(index.quantizer).hnsw.efSearch = efSearch
+                    index.nprobe = nprobe
             except Exception as e:
                 print(e)
                 print('Cannot set parameters for this index')
+            FAISS_Index._indexes[embedding_type] = index
 
             if self.api_version_1:
                 # Load the entity to index map
                 with open(self.config['qnode_to_ids_file']) as fd:
                     FAISS_Index._qnode_to_index = json.load(fd)
                 FAISS_Index._index_to_qnode = {v: k for k, v in self._qnode_to_index.items()}
+        self._index = self._indexes.get(embedding_type)
+
+    @classmethod
+    def get_index_file(cls, embedding_type):
+        """Return the configured index file for 'embedding_type' or None if there is none.
+        API version 1 only has a single ComplEx index.
+        """
+        if str(config.get('api_version')) == '1':
+            return config['faiss_index_file'] if embedding_type == 'complex' else None
+        config_key = cls.INDEX_CONFIG_KEYS.get(embedding_type)
+        return config_key and config.get(config_key)
+
+    def read_index(self, index_file):
+        """Read the FAISS index in 'index_file' memory-mapped and read-only if possible, so
+        its data is shared via the page cache by all worker processes instead of copied
+        onto each of their heaps.  Not all index types support this, in which case we
+        fall back to reading the index into memory.
+        """
+        if self.config.get('faiss_mmap', True):
+            try:
+                return faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError as e:
+                print(e)
+                print('Cannot memory-map this index')
+        return faiss.read_index(index_file)
 
     def get_neighbors_v1(self, qnode: str, k: int = 5):
         ''' Find the neighbors for the given qnode '''
 
-        # faiss returns the same qnode as first result
-        k += 1
-        scores, candidates = self._index.search(self._index.reconstruct(self._qnode_to_index[qnode]).reshape(1, -1), k)
-        candidates = [self._index_to_qnode[x] for x in candidates[0] if x != -1]
-        scores = scores[0][:len(candidates)]
-        scores = [float(x) for x in scores][1:]
-        candidates = candidates[1:]
+        # faiss usually returns the same qnode as first result, but not necessarily with ties,
+        # so we search for one more and remove it by its index ID:
+        qnode_id = self._qnode_to_index[qnode]
+        scores, candidates = self._index.search(self._index.reconstruct(qnode_id).reshape(1, -1), k + 1)
+        results = [(x, float(score)) for x, score in zip(candidates[0], scores[0]) if x != -1 and x != qnode_id][:k]
+        candidates = [self._index_to_qnode[x] for x, score in results]
+        scores = [score for x, score in results]
 
-        # this takes the most time for larger values of 'k', so speeding up that part
-        # and maybe restricting to embedding types we actually need would help:
-        candidates_label_dict = self.util.get_qnode_details(candidates)
+        candidates_label_dict = self.util.get_qnode_details(candidates, labels_only=True)
 
         result = []
 
@@ -79,20 +118,67 @@ class FAISS_Index(object):
         """
         if self.api_version_1:
             return self.get_neighbors_v1(qnode, k=k)
+        return self.get_neighbors_batch([qnode], k=k)[0]
 
-        result = []
-        embed = self.backend.get_node_embedding(qnode, 'complex')
-        if embed is None:
-            return result
-
-        # NOTE: faiss returns the identical 'qnode' as the first result:
-        scores, candidates = self._index.search(embed.reshape(1, -1), k + 1)
-        for i, (cand, score) in enumerate(zip(candidates[0], scores[0])):
-            if i > 0 and cand != -1:
-                for node, numid, label in self.backend.get_node_and_label_from_complex_emb_numid(cand):
-                    result.append({"qnode": node, "score": score, "label": self.util.normalize_label(label)})
+    def get_neighbors_batch(self, qnodes, k: int = 5):
+        """Find the top-k nearest neighbors for each of 'qnodes' and return them as a list
+        parallel to 'qnodes'.  All query embeddings are gathered at once and searched with a
+        single FAISS call which is parallelized over the queries, and each candidate node is
+        resolved only once.  Nodes without an embedding get an empty list of neighbors.
+        """
+        if self.api_version_1:
+            return [self.get_neighbors_v1(qnode, k=k) for qnode in qnodes]
+
+        results = [[] for qnode in qnodes]
+        rows = self.backend.get_node_embedding_rows(list(qnodes), self.embedding_type)
+        queries = [i for i, row in enumerate(rows) if row >= 0]
+        if len(queries) == 0:
+            return results
+        embeddings = self.backend.get_embeddings(self.embedding_type)
+        embeds = np.vstack([np.asarray(embeddings[rows[i]], dtype=np.float32) for i in queries])
+        if self.is_cosine_index():
+            # inner product scores are cosine similarities only for unit-normalized queries:
+            norms = np.linalg.norm(embeds, axis=1, keepdims=True)
+            norms[norms == 0.0] = 1.0
+            embeds = embeds / norms
+
+        # NOTE: faiss usually returns the identical 'qnode' as the first result, but not
+        # necessarily with ties, so we search for one more and remove it by its row:
+        scores, candidates = self._index.search(embeds, k + 1)
+        neighbors = self.resolve_neighbors(np.unique(candidates))
+        for i, cands, cand_scores in zip(queries, candidates, scores):
+            for cand, score in zip(cands, cand_scores):
+                neighbor = neighbors.get(cand)
+                if neighbor is not None and cand != rows[i] and len(results[i]) < k:
+                    results[i].append({"qnode": neighbor[0], "score": float(score), "label": neighbor[1]})
+        return results
+
+    def resolve_neighbors(self, candidates):
+        """Map FAISS index 'candidates' onto (node, label) tuples, ignoring missing results.
+        Uses a single vectorized gather over the reverse row index if it is available,
+        one numids query per candidate otherwise.
+        """
+        neighbors = {}
+        nodes = self.backend.get_embedding_row_nodes(candidates, self.embedding_type)
+        if nodes is not None:
+            labels = self.util.get_qnode_details([node for node in nodes if node is not None], labels_only=True)
+            for cand, node in zip(candidates, nodes):
+                if node is not None:
+                    neighbors[cand] = (node, labels.get(node, {}).get('label', ''))
+            return neighbors
+        for cand in candidates:
+            if cand != -1:
+                for node, numid, label in self.backend.get_node_and_label_from_emb_numid(cand, self.embedding_type):
+                    neighbors[cand] = (node, self.util.normalize_label(label))
                     break
-        return result
+        return neighbors
+
+    def is_cosine_index(self):
+        """Return True if the index uses the inner product metric, which we assume is over
+        unit-normalized vectors as built by 'scripts/build_faiss_index.py'.  Scores of such
+        an index are cosine similarities and its top-k results are the true top-k.
+        """
+        return self._index is not None and self._index.metric_type == faiss.METRIC_INNER_PRODUCT
 
     @property
     def index(self):
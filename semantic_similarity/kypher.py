@@ -3,14 +3,23 @@ Kypher query backend support for KGTK similarity computations.
 """
 
 import os.path
+import math
 import json
+import queue
+import sqlite3
+import threading
 
 import numpy as np
 import pandas as pd
 
 import kgtk.kypher.api as kapi
+import kgtk.kypher.sqlstore as sqlstore
 from   kgtk.exceptions import KGTKException
 
+from   semantic_similarity.arrays import NodeKeys, NodeRowIndex, NodeCounts, NodeLabels, ClassFeatureMatrix, ClassAncestors, NpyWriter
+from   semantic_similarity.arrays import load_arrays, save_arrays, get_array_file, load_manifest, save_manifest
+from   semantic_similarity.arrays import build_csr, encode_node_columns
+
 
 config = json.load(open('semantic_similarity/config.json'))
 
@@ -24,6 +33,11 @@ BACKEND_CONFIG = {
     'MAX_RESULTS'           : config.get('MAX_QUERY_RESULTS', 1000000),
     'MAX_CACHE_SIZE'        : config.get('LRU_CACHE_SIZE', 250000),
 
+    # number of read-only graph cache connections used by concurrent requests:
+    'BACKEND_POOL_SIZE'     : config.get('backend_pool_size', 1),
+    'SQLITE_MMAP_SIZE'      : config.get('sqlite_mmap_size', 2 ** 33),
+    'SQLITE_CACHE_SIZE'     : config.get('sqlite_cache_size', 2 ** 28),
+
     # input file names (or aliases) for various aspects of the KG:
     'KG_EDGES_GRAPH'        : config.get('KG_EDGES_GRAPH', 'claims'),
     'KG_LABELS_GRAPH'       : config.get('KG_LABELS_GRAPH', 'labels'),
@@ -38,29 +52,70 @@ BACKEND_CONFIG = {
     'KG_TRANSE_EMB_NUMIDS_GRAPH'    : config.get('KG_TRANSE_EMB_NUMIDS_GRAPH'),
     'KG_TEXT_EMB_NUMIDS_GRAPH'      : config.get('KG_TEXT_EMB_NUMIDS_GRAPH'),
 
+    # denormalized per-node label, class counts and embedding numids (see 'build-graph-cache-main.sh'):
+    'KG_NODE_INFO_GRAPH'            : config.get('KG_NODE_INFO_GRAPH'),
+    'KG_NODE_INFO_LANGUAGE'         : config.get('KG_NODE_INFO_LANGUAGE', 'en'),
+
     'NODE2VEC_EMBEDDINGS'           : config.get('NODE2VEC_EMBEDDINGS'),
     'COMPLEX_EMBEDDINGS'            : config.get('COMPLEX_EMBEDDINGS'),
     'TRANSE_EMBEDDINGS'             : config.get('TRANSE_EMBEDDINGS'),
     'TEXT_EMBEDDINGS'               : config.get('TEXT_EMBEDDINGS'),
+
+    # embedding types whose data files contain unit-normalized vectors:
+    'NORMALIZED_EMBEDDINGS'         : config.get('NORMALIZED_EMBEDDINGS', []),
+
+    # directory of precomputed memory-mappable arrays (see 'build_arrays.py'):
+    'ARRAY_STORE'                   : config.get('ARRAY_STORE'),
 }
 
 
+def normalize_label(label):
+    """Strip the KGTK string syntax from 'label' which is either an LQ-string such as
+    'Lebanon'@en with an arbitrary language tag or a regular "string", and unescape
+    any escaped quotes.  Other values are returned as is, and None is mapped onto ''.
+    """
+    if label is None:
+        return ''
+    if len(label) >= 2 and label[0] == "'":
+        end = label.rfind("'")
+        label = label[1:end] if end > 0 else label[1:]
+    elif len(label) >= 2 and label[0] == '"' and label[-1] == '"':
+        label = label[1:-1]
+    else:
+        return label
+    if '\\' in label:
+        label = label.replace("\\'", "'").replace('\\"', '"')
+    return label
+
+
 class SimilarityBackend(kapi.KypherApi):
     """
     Kypher query backend supporting similarity computations.
     This strongly assumes a KGTK DWD database.
     """
 
-    def __init__(self, config=BACKEND_CONFIG, loglevel=0):
-        super().__init__(config=config, loglevel=loglevel)
+    def __init__(self, config=BACKEND_CONFIG, loglevel=0, readonly=False, primary=None):
+        """Create a new backend.  If 'primary' is provided, this backend shares all loaded
+        embeddings and array structures with 'primary' and only adds its own graph cache
+        connection, which is how we create the additional backends of a 'BackendPool'.
+        """
+        super().__init__(config=config, loglevel=loglevel, readonly=readonly)
         # the initial version using the ElasticSearch backend:
         self.api_version_1 = str(self.get_config('API_VERSION')) == '1'
         
+        self.primary = primary or self
         self.all_class_counts = None
+        self.max_class_count = None
         self.node2vec_embeddings = None
-        self.complex_embeddings = None
-        self.transe_embeddings = None
-        self.text_embeddings = None
+        self.embeddings = {}
+        self.embedding_row_indexes = {}
+        self.embedding_norms = {}
+        self.array_structures = {}
+        if primary is not None:
+            self.embeddings = primary.embeddings
+            self.embedding_row_indexes = primary.embedding_row_indexes
+            self.embedding_norms = primary.embedding_norms
+            self.array_structures = primary.array_structures
         
         # define internal names/handles we can use for these inputs:
         self.add_input(self.get_config('KG_EDGES_GRAPH'),        name='edges',   handle=True)
@@ -78,14 +133,63 @@ class SimilarityBackend(kapi.KypherApi):
             self.add_input(self.get_config('KG_TRANSE_EMB_NUMIDS_GRAPH'),   name='transeemb_numids',  handle=True)
         if self.get_config('KG_TEXT_EMB_NUMIDS_GRAPH') is not None:
             self.add_input(self.get_config('KG_TEXT_EMB_NUMIDS_GRAPH'),   name='textemb_numids',  handle=True)
+        if self.get_config('KG_NODE_INFO_GRAPH') is not None:
+            self.add_input(self.get_config('KG_NODE_INFO_GRAPH'),   name='nodeinfo',  handle=True)
+
+    def get_sql_store(self):
+        """Create a new SQL store object for the configured graph cache or return a cached value.
+        In read-only mode, we open the graph cache as immutable which avoids any file locking,
+        and we use memory-mapped I/O and a smaller page cache since connections are pooled.
+        """
+        if self.sql_store is None and self.readonly:
+            conn = sqlite3.connect(f'file:{self.graph_cache}?mode=ro&immutable=1', uri=True, check_same_thread=False)
+            self.sql_store = sqlstore.SqliteStore(dbfile=self.graph_cache, conn=conn,
+                                                  loglevel=self.loglevel, readonly=True,
+                                                  aux_dbfiles=self.aux_dbfiles,
+                                                  single_user=self.single_user, piped=self.piped)
+            # these need to come after the store's own configuration which sets a larger cache size:
+            self.sql_store.pragma('query_only = 1')
+            self.sql_store.pragma('mmap_size = %d' % int(self.get_config('SQLITE_MMAP_SIZE')))
+            self.sql_store.pragma('main.cache_size = %d' % -int(self.get_config('SQLITE_CACHE_SIZE') // 1024))
+        return super().get_sql_store()
+
+    def release_sql_store(self, close=True):
+        """Drop the connection to the graph cache, which will be reopened on demand.
+        Use 'close=False' in forked child processes, which must not close connections
+        inherited from their parent.
+        """
+        if self.sql_store is not None:
+            if close:
+                self.sql_store.close()
+            self.sql_store = None
+
+    def preload(self):
+        """Load all available embeddings and array structures and look up any constant
+        values, so they can be shared by worker processes forked after this.
+        """
+        self.get_node_interns()
+        for embedding_type, (data_key, numids_graph) in self.EMBEDDING_TYPES.items():
+            data_file = self.get_config(data_key)
+            if data_file and os.path.exists(data_file):
+                self.get_embeddings(embedding_type)
+                self.get_embedding_norms(embedding_type)
+            self.get_embedding_row_index(embedding_type)
+        self.get_embedding_row_index('node2vec')
+        self.get_node_label_store()
+        self.get_class_count_table()
+        self.get_class_feature_matrix()
+        self.get_class_ancestors()
+        if self.get_config('KG_CLASS_COUNTS_GRAPH') is not None or self.api_version_1:
+            self.get_max_class_count()
 
     # these embedding accessors are here since the embeddings could be served directly from the DB:
 
     def get_node2vec_embeddings(self):
-        if self.node2vec_embeddings is None:
+        primary = self.primary
+        if primary.node2vec_embeddings is None:
             import gensim
-            self.node2vec_embeddings = gensim.models.Word2Vec.load(self.get_config('NODE2VEC_EMBEDDINGS'))
-        return self.node2vec_embeddings
+            primary.node2vec_embeddings = gensim.models.Word2Vec.load(self.get_config('NODE2VEC_EMBEDDINGS'))
+        return primary.node2vec_embeddings
 
     def get_embeddings_data_shape(self, data_file, numids_graph, dtype=np.float32):
         """Derive the shape of a full memory-mapped embeddings array from its 'data_file' and 'numids_graph'.
@@ -94,74 +198,283 @@ class SimilarityBackend(kapi.KypherApi):
         ndim = os.path.getsize(data_file) // ntotal // np.zeros(1, dtype=dtype).nbytes
         return ntotal, ndim
 
+    # embedding type -> (embeddings data file config key, numids graph handle):
+    EMBEDDING_TYPES = {
+        'complex': ('COMPLEX_EMBEDDINGS', 'complexemb_numids'),
+        'transe':  ('TRANSE_EMBEDDINGS',  'transeemb_numids'),
+        'text':    ('TEXT_EMBEDDINGS',    'textemb_numids'),
+    }
+
+    # node2vec embeddings are served by gensim, but we can still index their numids:
+    NODE2VEC_NUMIDS_GRAPH = 'node2vecemb_numids'
+
+    def get_numids_graph(self, embedding_type):
+        """Return the numids graph handle for 'embedding_type' (which includes 'node2vec').
+        """
+        if embedding_type == 'node2vec':
+            return self.NODE2VEC_NUMIDS_GRAPH
+        return self.EMBEDDING_TYPES[embedding_type][1]
+
+    def get_embeddings(self, embedding_type):
+        """Return the memory-mapped embeddings array for 'embedding_type'.
+        """
+        embeddings = self.embeddings.get(embedding_type)
+        if embeddings is None:
+            data_key, numids_graph = self.EMBEDDING_TYPES[embedding_type]
+            data_file = self.get_config(data_key)
+            if data_file.endswith('.npy'):
+                # .npy files carry their own shape and dtype header (see 'transcode_vectors.py'):
+                embeddings = np.load(data_file, mmap_mode='r')
+            else:
+                dtype = np.float32
+                ntotal, ndim = self.get_embeddings_data_shape(data_file, numids_graph, dtype=dtype)
+                embeddings = np.memmap(data_file, dtype=dtype, mode='r', shape=(ntotal, ndim))
+            self.embeddings[embedding_type] = embeddings
+        return embeddings
+
     def get_complex_embeddings(self):
-        if self.complex_embeddings is None:
-            data_file = self.get_config('COMPLEX_EMBEDDINGS')
-            dtype = np.float32
-            ntotal, ndim = self.get_embeddings_data_shape(data_file, 'complexemb_numids', dtype=dtype)
-            self.complex_embeddings = np.memmap(data_file, dtype=dtype, mode='r', shape=(ntotal, ndim))
-        return self.complex_embeddings
+        return self.get_embeddings('complex')
     
     def get_transe_embeddings(self):
-        if self.transe_embeddings is None:
-            data_file = self.get_config('TRANSE_EMBEDDINGS')
-            dtype = np.float32
-            ntotal, ndim = self.get_embeddings_data_shape(data_file, 'transeemb_numids', dtype=dtype)
-            self.transe_embeddings = np.memmap(data_file, dtype=dtype, mode='r', shape=(ntotal, ndim))
-        return self.transe_embeddings
+        return self.get_embeddings('transe')
 
     def get_text_embeddings(self):
-        if self.text_embeddings is None:
-            data_file = self.get_config('TEXT_EMBEDDINGS')
-            dtype = np.float32
-            ntotal, ndim = self.get_embeddings_data_shape(data_file, 'textemb_numids', dtype=dtype)
-            self.text_embeddings = np.memmap(data_file, dtype=dtype, mode='r', shape=(ntotal, ndim))
-        return self.text_embeddings
+        return self.get_embeddings('text')
 
-    def get_node_embedding(self, qnode, embedding_type):
-        # TO DO: maybe have separate methods for these
-        if embedding_type == "complex":
-            embeddings = self.get_complex_embeddings()
-            for node, numid, label in self.get_node_complex_emb_numid_and_label(qnode):
-                return embeddings[int(numid)]
-        elif embedding_type == "transe":
-            embeddings = self.get_transe_embeddings()
-            for node, numid, label in self.get_node_transe_emb_numid_and_label(qnode):
-                return embeddings[int(numid)]
-        elif embedding_type == "text":
-            embeddings = self.get_text_embeddings()
-            for node, numid, label in self.get_node_text_emb_numid_and_label(qnode):
-                return embeddings[int(numid)]
+    def get_array_store_file(self, name):
+        """Return the file prefix for the precomputed array structure 'name',
+        or None if no array store has been configured.
+        """
+        store = self.get_config('ARRAY_STORE')
+        return os.path.join(store, name) if store else None
+
+    NODE_INTERNS_STRUCTURE = 'nodes'
+
+    def get_graph_cache_version(self):
+        """Return a description of the configured graph cache which ties the array store
+        to the graph cache version it was built from.
+        """
+        cache = self.get_config('GRAPH_CACHE')
+        if cache and os.path.exists(cache):
+            return {'graph_cache': os.path.basename(cache), 'size': os.path.getsize(cache)}
+
+    def get_node_interns(self):
+        """Return the node intern table shared by all array structures, which maps node name
+        strings onto dense integer node ids and back.  Return None if it is not available
+        or was built from a different version of the graph cache, in which case none of
+        the array structures will be used.
+        """
+        if self.NODE_INTERNS_STRUCTURE not in self.array_structures:
+            interns = None
+            prefix = self.get_array_store_file(self.NODE_INTERNS_STRUCTURE)
+            manifest = prefix and load_manifest(prefix)
+            if manifest is not None:
+                if manifest.get('version') == self.get_graph_cache_version():
+                    interns = NodeKeys.load(prefix)
+                else:
+                    print(f'Ignoring array store built for a different graph cache: {manifest.get("version")}')
+            self.array_structures[self.NODE_INTERNS_STRUCTURE] = interns
+        return self.array_structures[self.NODE_INTERNS_STRUCTURE]
+
+    def build_node_interns(self, prefix=None):
+        """Build the node intern table from all nodes of the graphs used by the array
+        structures and save it under 'prefix' (which defaults to its standard location in
+        the array store).  All other array structures need to be rebuilt after this.
+        """
+        prefix = prefix or self.get_array_store_file(self.NODE_INTERNS_STRUCTURE)
+        queries = [
+            ('$edges: (n)-[r]->(parent)', 'r.label in ["P31", "P279"]', 'n as node1, parent as node2'),
+            ('$p279*: (class)-[]->(super)', None, 'class as node1, super as super'),
+        ]
+        for handle in ('classcounts', 'node2vecemb_numids', 'complexemb_numids', 'transeemb_numids', 'textemb_numids'):
+            if self.get_input_info(handle) is not None:
+                queries.append((f'${handle}: (n)-[]->()', None, 'n as node1'))
+        keys = np.array([], dtype=np.bytes_)
+        for match, where, ret in queries:
+            query = self.get_query(match=match, where=where, ret=ret, limit=-1, maxcache=0)
+            columns = encode_node_columns(query.execute(fmt='iter'), ret.count(' as '))
+            keys = np.unique(np.concatenate([keys] + columns))
+        if self.get_input_info('classcounts_compact') is not None:
+            # these include the classes of each node which are not necessarily in the class counts graph:
+            query = self.get_query(inputs=self.get_input('classcounts_compact'), match='(n)-[]->(c)',
+                                   ret='n as node1, c as counts', limit=-1, maxcache=0)
+            def get_nodes_and_classes():
+                for node, counts in query.execute(fmt='iter'):
+                    yield (node,)
+                    for entry in counts.split('|'):
+                        if entry:
+                            yield (entry.split(':')[0],)
+            keys = np.unique(np.concatenate([keys] + encode_node_columns(get_nodes_and_classes(), 1)))
+        interns = NodeKeys(keys)
+        interns.save(prefix)
+        save_manifest(prefix, {'version': self.get_graph_cache_version(), 'nodes': len(interns)})
+        # force reload of the new interns and all structures depending on them:
+        self.array_structures.clear()
+        self.embedding_row_indexes.clear()
+        return self.get_node_interns()
+
+    def require_node_interns(self):
+        interns = self.get_node_interns()
+        if interns is None:
+            raise KGTKException('node interns need to be built before any other array structures')
+        return interns
+
+    def load_array_structure(self, name, structure_class):
+        """Return the precomputed array structure 'name' of type 'structure_class' from the
+        array store, or None if it is not available.  Structures are only loaded once.
+        """
+        if name not in self.array_structures:
+            prefix = self.get_array_store_file(name)
+            interns = prefix and self.get_node_interns()
+            self.array_structures[name] = interns and structure_class.load(prefix, interns)
+        return self.array_structures[name]
+
+    def get_embedding_row_index(self, embedding_type):
+        """Return the precomputed node-to-row index for 'embedding_type' or None
+        if it is not available, in which case rows need to be looked up via queries.
+        """
+        if embedding_type not in self.embedding_row_indexes:
+            numids_graph = self.get_numids_graph(embedding_type)
+            self.embedding_row_indexes[embedding_type] = self.load_array_structure(numids_graph + '.rowindex', NodeRowIndex)
+        return self.embedding_row_indexes[embedding_type]
+
+    def build_embedding_row_index(self, embedding_type, prefix=None):
+        """Build the node-to-row index for 'embedding_type' (including its reverse
+        row-to-node mapping) from its numids graph with a single full scan and save
+        it under 'prefix' (which defaults to its standard location in the array store).
+        """
+        interns = self.require_node_interns()
+        numids_graph = self.get_numids_graph(embedding_type)
+        prefix = prefix or self.get_array_store_file(numids_graph + '.rowindex')
+        query = self.get_query(inputs=numids_graph, match='(n)-[]->(numid)',
+                               ret='n as node1, numid as numid', limit=-1, maxcache=0)
+        nodes, rows = [], []
+        for node, numid in query.execute(fmt='iter'):
+            nodes.append(node)
+            rows.append(int(numid))
+        index = NodeRowIndex.build(interns, nodes, rows)
+        index.save(prefix)
+        self.array_structures.pop(numids_graph + '.rowindex', None)
+        self.embedding_row_indexes.pop(embedding_type, None)
+        return index
+
+    def get_embedding_row_nodes(self, rows, embedding_type):
+        """Return a list with the nodes of the embedding 'rows' of 'embedding_type' and None
+        for unknown rows, decoded with a single vectorized gather.  Return None if the reverse
+        mapping is not available, in which case rows need to be decoded via queries.
+        """
+        row_index = self.get_embedding_row_index(embedding_type)
+        if row_index is not None and row_index.has_row_ids():
+            return row_index.get_row_nodes(rows)
         return None
 
+    def is_normalized_embeddings(self, embedding_type):
+        """Return True if the data file for 'embedding_type' contains unit-normalized vectors.
+        """
+        return embedding_type in self.get_config('NORMALIZED_EMBEDDINGS')
+
+    def get_embedding_norms(self, embedding_type):
+        """Return the precomputed array of row norms for 'embedding_type' or None if it
+        is not available or not needed, since the embedding vectors are already normalized.
+        """
+        if embedding_type not in self.embedding_norms:
+            norms = None
+            if not self.is_normalized_embeddings(embedding_type):
+                prefix = self.get_array_store_file(self.EMBEDDING_TYPES[embedding_type][1])
+                norms = prefix and load_arrays(prefix, 'norms')
+                norms = norms and norms[0]
+            self.embedding_norms[embedding_type] = norms
+        return self.embedding_norms[embedding_type]
+
+    def build_embedding_norms(self, embedding_type, prefix=None, chunksize=1000000):
+        """Compute the row norms of the embeddings for 'embedding_type' in chunks
+        and save them under 'prefix' (which defaults to the array store).
+        """
+        prefix = prefix or self.get_array_store_file(self.EMBEDDING_TYPES[embedding_type][1])
+        embeddings = self.get_embeddings(embedding_type)
+        norms = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), chunksize):
+            norms[start:start + chunksize] = np.linalg.norm(embeddings[start:start + chunksize], axis=1)
+        save_arrays(prefix, norms=norms)
+        self.embedding_norms.pop(embedding_type, None)
+        return norms
+
+    def is_embedding_store_loaded(self, embedding_type):
+        """Return True if rows and vectors for 'embedding_type' are available without any further queries.
+        """
+        return (self.embedding_row_indexes.get(embedding_type) is not None and
+                self.embeddings.get(embedding_type) is not None)
+
+    def get_node_embedding_rows(self, qnodes, embedding_type):
+        """Return an int64 array with the embedding rows of 'qnodes' for 'embedding_type'
+        and -1 for nodes without an embedding.  Uses a single vectorized lookup if the
+        precomputed row index is available, a batched numids query otherwise.
+        """
+        row_index = self.get_embedding_row_index(embedding_type)
+        if row_index is not None:
+            return row_index.lookup(qnodes)
+        numids = self.get_node_emb_numid_and_label_batch(qnodes, embedding_type)
+        rows = np.full(len(qnodes), -1, dtype=np.int64)
+        for i, qnode in enumerate(qnodes):
+            if qnode in numids:
+                rows[i] = int(numids[qnode][0])
+        return rows
+
+    def get_node_embedding(self, qnode, embedding_type):
+        if embedding_type not in self.EMBEDDING_TYPES:
+            return None
+        embeddings = self.get_embeddings(embedding_type)
+        row = self.get_node_embedding_rows([qnode], embedding_type)[0]
+        return embeddings[row] if row >= 0 else None
+
     def get_node_embeddings(self, qnodes, embedding_type):
-        # TO DO: maybe have separate methods for these
-        numids = [None] * len(qnodes)
-        if embedding_type == "complex":
-            embeddings = self.get_complex_embeddings()
-            for i, qnode in enumerate(qnodes):
-                for node, numid, label in self.get_node_complex_emb_numid_and_label(qnode):
-                    numids[i] = int(numid)
-        elif embedding_type == "transe":
-            embeddings = self.get_transe_embeddings()
-            for i, qnode in enumerate(qnodes):
-                for node, numid, label in self.get_node_transe_emb_numid_and_label(qnode):
-                    numids[i] = int(numid)
-        elif embedding_type == "text":
-            embeddings = self.get_text_embeddings()
-            for i, qnode in enumerate(qnodes):
-                for node, numid, label in self.get_node_text_emb_numid_and_label(qnode):
-                    numids[i] = int(numid)
-        return [embeddings[i] if i is not None else None for i in numids]
+        if embedding_type not in self.EMBEDDING_TYPES:
+            return [None] * len(qnodes)
+        embeddings = self.get_embeddings(embedding_type)
+        rows = self.get_node_embedding_rows(qnodes, embedding_type)
+        return [embeddings[row] if row >= 0 else None for row in rows]
+
+    CLASS_COUNTS_STRUCTURE = 'classcounts.counts'
+
+    def get_class_count_table(self):
+        """Return the precomputed class count table or None if it is not available.
+        """
+        return self.load_array_structure(self.CLASS_COUNTS_STRUCTURE, NodeCounts)
+
+    def build_class_count_table(self, prefix=None):
+        """Build the class count table from the class counts graph (or the class counts
+        JSON file for API version 1) and save it under 'prefix' (which defaults to its
+        standard location in the array store).
+        """
+        interns = self.require_node_interns()
+        prefix = prefix or self.get_array_store_file(self.CLASS_COUNTS_STRUCTURE)
+        if self.api_version_1:
+            class_counts = json.load(open(self.get_config('ALL_CLASS_COUNTS_FILE')))
+            nodes, counts = list(class_counts.keys()), list(class_counts.values())
+            del class_counts
+        else:
+            query = self.get_query(inputs=self.get_input('classcounts'), match='(n)-[]->(c)',
+                                   ret='n as node1, c as count', limit=-1, maxcache=0)
+            nodes, counts = [], []
+            for node, count in query.execute(fmt='iter'):
+                nodes.append(node)
+                counts.append(int(count))
+        NodeCounts.build(interns, nodes, counts).save(prefix)
+        self.array_structures.pop(self.CLASS_COUNTS_STRUCTURE, None)
+        return self.get_class_count_table()
 
     def get_class_count(self, klass, dflt=0):
         """Return the transitive instance count for 'klass',
         or 'dflt' if no class count is defined for 'klass'.
         """
+        table = self.get_class_count_table()
+        if table is not None:
+            return table.lookup([klass], dflt=dflt)[0].item()
         if self.api_version_1:
-            if self.all_class_counts is None:
-                self.all_class_counts = json.load(open(self.get_config('ALL_CLASS_COUNTS_FILE')))
-            return self.all_class_counts.get(klass, dflt)
+            primary = self.primary
+            if primary.all_class_counts is None:
+                primary.all_class_counts = json.load(open(self.get_config('ALL_CLASS_COUNTS_FILE')))
+            return primary.all_class_counts.get(klass, dflt)
         else:
             query_name = 'get_class_count'
             query = (self.lookup_query(query_name) or
@@ -175,10 +488,45 @@ class SimilarityBackend(kapi.KypherApi):
                 return int(count)
             return dflt
 
+    def get_class_counts(self, classes, dflt=0):
+        """Return a list of transitive instance counts for each of 'classes',
+        with 'dflt' for any class that has no class count defined.
+        """
+        table = self.get_class_count_table()
+        if table is not None:
+            return table.lookup(classes, dflt=dflt).tolist()
+        if self.api_version_1:
+            return [self.get_class_count(klass, dflt) for klass in classes]
+        counts = self.get_class_count_batch(classes)
+        return [counts.get(klass, dflt) for klass in classes]
+
+    def get_class_count_batch(self, classes):
+        """Batched version of 'get_class_count' which looks up the transitive instance
+        counts of all 'classes' with a single query and returns them as a dict keyed by
+        class, where classes without a class count are omitted.
+        """
+        counts = {}
+        for node, count in self.execute_node_list_query('get_class_count_batch', classes,
+                                                        inputs=self.get_input('classcounts'),
+                                                        match='(n)-[]->(c)',
+                                                        where='n in $NODES',
+                                                        ret='n as node1, c as count'):
+            counts.setdefault(node, int(count))
+        return counts
+
+    def is_class_count_table_loaded(self):
+        """Return True if class counts are available without any further queries.
+        """
+        return self.array_structures.get(self.CLASS_COUNTS_STRUCTURE) is not None
+
     WD_ENTITY_CLASS_NODE = 'Q35120'
     
     def get_max_class_count(self):
-        return self.get_class_count(self.WD_ENTITY_CLASS_NODE)
+        # this never changes, so we only need to look it up once:
+        primary = self.primary
+        if primary.max_class_count is None:
+            primary.max_class_count = self.get_class_count(self.WD_ENTITY_CLASS_NODE)
+        return primary.max_class_count
                    
     def get_class_counts_compact(self, node):
         """Return the transitive instance count for all supers of 'node'.
@@ -195,7 +543,98 @@ class SimilarityBackend(kapi.KypherApi):
                             limit=1))
         for node, counts in self.execute_query(query, NODE=node):
             return counts
+
+    def get_class_counts_compact_batch(self, nodes):
+        """Batched version of 'get_class_counts_compact' which retrieves the compact class
+        counts of all 'nodes' with a single query and returns them as a dict keyed by node,
+        where nodes without class counts are omitted.
+        """
+        counts = {}
+        for node, node_counts in self.execute_node_list_query('get_class_counts_compact_batch', nodes,
+                                                              inputs=self.get_input('classcounts_compact'),
+                                                              match='(n)-[]->(c)',
+                                                              where='n in $NODES',
+                                                              ret='n as node1, c as counts'):
+            counts.setdefault(node, node_counts)
+        return counts
             
+    CLASS_FEATURES_STRUCTURE = 'classcounts_compact.features'
+
+    def get_class_feature_matrix(self):
+        """Return the precomputed sparse node-to-classes matrix used by the class similarity
+        computation, or None if it is not available.
+        """
+        return self.load_array_structure(self.CLASS_FEATURES_STRUCTURE, ClassFeatureMatrix)
+
+    def build_class_feature_matrix(self, prefix=None, chunksize=100000):
+        """Build the sparse node-to-classes matrix from the compact class counts graph
+        and save it under 'prefix' (which defaults to its standard location in the array
+        store).  The first scan collects all classes and their instance counts which become
+        the matrix columns, the second one writes one row per node in CSR format.
+        Similar to 'ClassSimilarity.build_qnode_feature_dict', the node itself counts as
+        one of its classes, but we only need a column for it if it is a class of some
+        other node, otherwise it only contributes its IDF weight to the row sum.
+        """
+        interns = self.require_node_interns()
+        prefix = prefix or self.get_array_store_file(self.CLASS_FEATURES_STRUCTURE)
+        query = self.get_query(inputs=self.get_input('classcounts_compact'), match='(n)-[]->(c)',
+                               ret='n as node1, c as counts', limit=-1, maxcache=0)
+        class_counts = {}
+        for node, counts in query.execute(fmt='iter'):
+            for entry in counts.split('|'):
+                if entry:
+                    vals = entry.split(':')
+                    class_counts[vals[0]] = float(vals[1])
+        classes, order = NodeKeys.from_nodes(list(class_counts.keys()))
+        instance_counts = np.array(list(class_counts.values()), dtype=np.float64)[order]
+        columns = {node: col for col, node in enumerate(classes.get_nodes(np.arange(len(classes))))}
+        del class_counts
+        
+        n_total = float(self.get_max_class_count())
+        idf = np.log(n_total / instance_counts)
+        other_counts = {}
+        if self.get_config('KG_CLASS_COUNTS_GRAPH') is not None:
+            # instance counts of nodes that aren't classes of any other node, which are rare:
+            count_query = self.get_query(inputs=self.get_input('classcounts'), match='(n)-[]->(c)',
+                                         ret='n as node1, c as count', limit=-1, maxcache=0)
+            for node, count in count_query.execute(fmt='iter'):
+                if node not in columns:
+                    other_counts[node] = float(count)
+
+        save_arrays(prefix, idf=idf, classes=interns.lookup_encoded(classes.keys).astype(np.int32))
+        indptr_writer = NpyWriter(get_array_file(prefix, 'indptr'), np.int64)
+        indices_writer = NpyWriter(get_array_file(prefix, 'indices'), np.int32)
+        nodes, weights = [], []
+        indptr, indices = [0], []
+        offset = 0
+        for node, counts in query.execute(fmt='iter'):
+            row = [columns[entry.split(':')[0]] for entry in counts.split('|') if entry]
+            weight = 0.0
+            col = columns.get(node)
+            if col is not None:
+                row.append(col)
+            else:
+                weight = math.log(n_total / other_counts.get(node, 1.0))
+            row = np.unique(np.array(row, dtype=np.int32))
+            weights.append(weight + idf[row].sum())
+            nodes.append(node)
+            indices.append(row)
+            offset += len(row)
+            indptr.append(offset)
+            if len(indptr) > chunksize:
+                indptr_writer.append(indptr[:-1])
+                indices_writer.append(np.concatenate(indices))
+                indptr, indices = indptr[-1:], []
+        indptr_writer.append(indptr)
+        if indices:
+            indices_writer.append(np.concatenate(indices))
+        indptr_writer.close()
+        indices_writer.close()
+        save_arrays(prefix, weights=np.array(weights, dtype=np.float64))
+        NodeRowIndex.build(interns, nodes, np.arange(len(nodes))).save(prefix)
+        self.array_structures.pop(self.CLASS_FEATURES_STRUCTURE, None)
+        return self.get_class_feature_matrix()
+
     def get_node_edges(self, node, fmt=None):
         """Retrieve all edges that have 'node' as their node1.
         """
@@ -208,21 +647,86 @@ class SimilarityBackend(kapi.KypherApi):
                                 ret='r as id, n as node1, r.label as label, n2 as node2'))
         return self.execute_query(query, fmt=fmt, NODE=node)
 
+    LABELS_STRUCTURE = 'labels'
+
+    def get_node_label_store(self):
+        """Return the precomputed label table for 'DEFAULT_LANGUAGE' or None if it is not available.
+        """
+        return self.load_array_structure(f'{self.LABELS_STRUCTURE}.{self.get_config("DEFAULT_LANGUAGE")}', NodeLabels)
+
+    def build_node_label_store(self, prefix=None):
+        """Build the table of normalized 'DEFAULT_LANGUAGE' labels from the labels graph
+        with a single full scan and save it under 'prefix' (which defaults to its
+        standard location in the array store).
+        """
+        interns = self.require_node_interns()
+        name = f'{self.LABELS_STRUCTURE}.{self.get_config("DEFAULT_LANGUAGE")}'
+        prefix = prefix or self.get_array_store_file(name)
+        query = self.get_query(inputs=self.get_input('labels'), match='(n)-[]->(l)',
+                               where='kgtk_lqstring_lang(l) = $LANG',
+                               ret='n as node1, l as label', limit=-1, maxcache=0)
+        rows = ((node, normalize_label(label)) for node, label in query.execute(fmt='iter', LANG=self.get_config('DEFAULT_LANGUAGE')))
+        NodeLabels.build(interns, rows, prefix)
+        self.array_structures.pop(name, None)
+        return self.get_node_label_store()
+
+    def lookup_stored_node_labels(self, nodes):
+        """Look up the labels of 'nodes' in the precomputed label table if it is available.
+        Return a dict with the labels found and the list of nodes not covered by the table.
+        """
+        store = self.get_node_label_store()
+        if store is None:
+            return {}, list(nodes)
+        labels, missing = {}, []
+        ids = store.interns.lookup(nodes)
+        for node, node_id, label in zip(nodes, ids, store.lookup_ids(ids)):
+            if node_id < 0:
+                missing.append(node)
+            elif label is not None:
+                labels[node] = label
+        return labels, missing
+
+    def get_node_labels(self, nodes):
+        """Return a dict with the normalized labels of those 'nodes' that have one.  Nodes in
+        the precomputed label table are looked up all at once, all others with a single query.
+        """
+        labels, missing = self.lookup_stored_node_labels(nodes)
+        if missing:
+            for node, label in self.get_node_label_batch(missing).items():
+                if label:
+                    labels[node] = normalize_label(label)
+        return labels
+
     def get_node_label(self, node):
-        """Retrieve one English label for 'node'.
+        """Retrieve one 'DEFAULT_LANGUAGE' label for 'node'.
         """
         query_name = 'get_node_label'
         query = (self.lookup_query(query_name) or
                  self.get_query(name=query_name,
                                 inputs=self.get_input('labels'),
                                 match='(n)-[r]->(l)',
-                                where='n=$NODE and kgtk_lqstring_lang(l) = "en"',
+                                where='n=$NODE and kgtk_lqstring_lang(l) = $LANG',
                                 ret='n as node1, l as label',
                                 limit=1))
-        for node, label in self.execute_query(query, NODE=node):
+        for node, label in self.execute_query(query, NODE=node, LANG=self.get_config('DEFAULT_LANGUAGE')):
             return label
         return None
 
+    def get_node_label_batch(self, nodes):
+        """Batched version of 'get_node_label' which retrieves one 'DEFAULT_LANGUAGE' label for each of
+        'nodes' with a single query and returns them as a dict keyed by node, where nodes
+        without a label are omitted.
+        """
+        labels = {}
+        for node, label in self.execute_node_list_query('get_node_label_batch', nodes,
+                                                        inputs=self.get_input('labels'),
+                                                        match='(n)-[r]->(l)',
+                                                        where='n in $NODES and kgtk_lqstring_lang(l) = $LANG',
+                                                        ret='n as node1, l as label',
+                                                        params={'LANG': self.get_config('DEFAULT_LANGUAGE')}):
+            labels.setdefault(node, label)
+        return labels
+
     def get_node_proper_supers(self, node, fmt=None):
         """Retrieve all supers for 'node' as well as their English labels.
         The first supers might be linked by P31 and/or P279, subsequent ones through P279 only.
@@ -277,6 +781,22 @@ class SimilarityBackend(kapi.KypherApi):
                                    order= 'n, super')
         return self.execute_query(query, fmt=fmt, NODE=node)
 
+    def get_node_direct_supers_batch(self, nodes):
+        """Batched version of 'get_node_direct_supers' which retrieves the direct parents of
+        all 'nodes' with a single query and returns a dict keyed by node with the list of
+        result rows of each node, where nodes without parents are omitted.
+        """
+        supers = {}
+        for row in self.execute_node_list_query('get_node_direct_supers_batch', nodes,
+                                                match= '$edges: (n)-[r]->(parent)',
+                                                where= 'n in $NODES and r.label in ["P31", "P279"]',
+                                                opt=   '$labels: (n)-[]->(l)',
+                                                owhere='kgtk_lqstring_lang(l) = "en"',
+                                                ret=   'distinct n as node1, n as super, l as label, parent as parent',
+                                                order= 'n, super'):
+            supers.setdefault(row[0], []).append(row)
+        return supers
+
     def get_node_direct_subs(self, node, fmt=None):
         """Retrieve all direct children for 'node' as well as node's English label.
         Children may be linked via P279 only.  This could be done more simply but is
@@ -431,16 +951,113 @@ class SimilarityBackend(kapi.KypherApi):
                                    ret=   'distinct n as node1, numid as numid, l as label')
         return self.execute_query(query, fmt=fmt, NUMID=str(numid))
 
+    def get_node_emb_numid_and_label_batch(self, nodes, embedding_type):
+        """Batched version of the 'get_node_<type>_emb_numid_and_label' family which retrieves
+        the numeric node IDs and labels of all 'nodes' for 'embedding_type' (which includes
+        'node2vec') with a single query.  Returns a dict keyed by node with a (numid, label)
+        tuple for each node, where nodes without a numid are omitted.
+        """
+        numids_graph = self.get_numids_graph(embedding_type)
+        numids = {}
+        for node, numid, label in self.execute_node_list_query(f'get_node_{embedding_type}_emb_numid_and_label_batch', nodes,
+                                                               match= f'${numids_graph}: (n)-[r]->(numid)',
+                                                               where= 'n in $NODES',
+                                                               opt=   '$labels: (n)-[]->(l)',
+                                                               owhere='kgtk_lqstring_lang(l) = "en"',
+                                                               ret=   'distinct n as node1, numid as numid, l as label'):
+            numids.setdefault(node, (numid, label))
+        return numids
+
+    def get_node_and_label_from_emb_numid(self, numid, embedding_type, fmt=None):
+        """Retrieve the QNode ID and label for the node encoded by 'numid' in the
+        numids graph of 'embedding_type'.
+        """
+        if embedding_type == 'complex':
+            return self.get_node_and_label_from_complex_emb_numid(numid, fmt=fmt)
+        elif embedding_type == 'transe':
+            return self.get_node_and_label_from_transe_emb_numid(numid, fmt=fmt)
+        elif embedding_type == 'text':
+            return self.get_node_and_label_from_text_emb_numid(numid, fmt=fmt)
+        raise KGTKException(f'unsupported embedding type: {embedding_type}')
+
     
+    # maximum number of nodes bound as parameters of a single node list query, which needs
+    # to stay below SQLite's limit on query parameters (999 for older versions):
+    MAX_NODE_LIST_SIZE = 512
+
+    def execute_node_list_query(self, query_name, nodes, params=None, **query_args):
+        """Run the query defined by 'query_args' for the list of 'nodes' and return all result
+        rows as tuples.  The 'where' clause refers to the list as '$NODES', which is bound to
+        one parameter per node, any other query parameters can be supplied via 'params'.
+        To limit the number of distinct queries we need to translate and cache, lists are
+        padded to the next power of two by repeating their last node, and longer lists
+        are run in chunks of 'MAX_NODE_LIST_SIZE' nodes.  Results are not
+        cached, since multi-node results are rarely reused and per-node details are already
+        cached by 'Utility.get_qnode_details'.
+        """
+        results = []
+        nodes = list(nodes)
+        for start in range(0, len(nodes), self.MAX_NODE_LIST_SIZE):
+            chunk = nodes[start:start + self.MAX_NODE_LIST_SIZE]
+            size = 1 << (len(chunk) - 1).bit_length()
+            chunk_query_name = f'{query_name}_{size}'
+            query = self.lookup_query(chunk_query_name)
+            if query is None:
+                node_list = '[' + ', '.join(f'$NODE{i}' for i in range(size)) + ']'
+                chunk_query_args = dict(query_args, where=query_args['where'].replace('$NODES', node_list))
+                query = self.get_query(name=chunk_query_name, maxcache=0, **chunk_query_args)
+            chunk_params = dict(params or {})
+            chunk_params.update({f'NODE{i}': chunk[min(i, len(chunk) - 1)] for i in range(size)})
+            results.extend(self.execute_query(query, **chunk_params))
+        return results
+
+    def has_node_info_table(self):
+        """Return True if the graph cache has the denormalized node info table.
+        """
+        return self.get_config('KG_NODE_INFO_GRAPH') is not None
+
+    def has_node_info_labels(self):
+        """Return True if the labels of the node info table are in 'DEFAULT_LANGUAGE',
+        otherwise labels need to be looked up separately.
+        """
+        return self.get_config('KG_NODE_INFO_LANGUAGE') == self.get_config('DEFAULT_LANGUAGE')
+
+    def get_nodes_info(self, nodes):
+        """Retrieve the normalized 'KG_NODE_INFO_LANGUAGE' label, compact class counts, class count and
+        ComplEx, TransE and text embedding numids for all of 'nodes' with a single batched
+        query to the node info table.  Return a dict keyed by node with a dict of these
+        fields for each node found, where missing values are represented by None.
+        """
+        rows = self.execute_node_list_query(
+            'get_nodes_info', nodes,
+            inputs=self.get_input('nodeinfo'),
+            match='(n)-[r]->(l)',
+            where='n in $NODES',
+            ret='n as node1, l as label, r.classcounts as classcounts, r.classcount as classcount, ' +
+                'r.complexemb_numid as complexemb_numid, r.transeemb_numid as transeemb_numid, ' +
+                'r.textemb_numid as textemb_numid')
+        nodes_info = {}
+        for node, label, classcounts, classcount, *numids in rows:
+            # nodes with multiple English labels have multiple rows, we use the first one:
+            if node not in nodes_info:
+                info = {
+                    'label': normalize_label(label) if label else None,
+                    'classcounts': classcounts or None,
+                    'classcount': int(classcount) if classcount else None,
+                }
+                for embedding_type, numid in zip(('complex', 'transe', 'text'), numids):
+                    info[f'{embedding_type}emb_numid'] = int(numid) if numid else None
+                nodes_info[node] = info
+        return nodes_info
+
     def get_node_neighbors(self, node, maxup=1, maxdown=1):
         # step 1: find all parents up to a distance of 'maxup':
         seeds = {node}
         neighbors = set()
         for i in range(maxup):
             new = set()
-            for seed in seeds:
-                supers = [parent for node, super, label, parent in self.get_node_direct_supers(seed)]
-                new.update(supers)
+            for rows in self.get_node_direct_supers_batch(list(seeds)).values():
+                new.update([parent for node, super, label, parent in rows])
             seeds = new.difference(neighbors)
             neighbors.update(new)
         parents = neighbors
@@ -479,9 +1096,53 @@ class SimilarityBackend(kapi.KypherApi):
         mssdf = mssdf.drop_duplicates().copy()
         return mssdf
 
+    CLASS_ANCESTORS_STRUCTURE = 'p279star.ancestors'
+
+    def get_class_ancestors(self):
+        """Return the precomputed class ancestor structure used to compute most specific
+        subsumers, or None if it is not available.
+        """
+        return self.load_array_structure(self.CLASS_ANCESTORS_STRUCTURE, ClassAncestors)
+
+    def build_class_ancestors(self, prefix=None):
+        """Build the class ancestor structure from the P31/P279 edges of the KG and the
+        P279star graph and save it under 'prefix' (which defaults to its standard location
+        in the array store).  These are the same inputs as used by 'get_node_supers_with_parents'.
+        """
+        interns = self.require_node_interns()
+        prefix = prefix or self.get_array_store_file(self.CLASS_ANCESTORS_STRUCTURE)
+        edge_query = self.get_query(match='$edges: (n)-[r]->(parent)',
+                                    where='r.label in ["P31", "P279"]',
+                                    ret=  'n as node1, parent as parent, r.label as label',
+                                    limit=-1, maxcache=0)
+        isa_nodes, isa_parents, isa_labels = encode_node_columns(edge_query.execute(fmt='iter'), 3)
+        star_query = self.get_query(match='$p279*: (class)-[]->(super)',
+                                    ret=  'class as node1, super as super',
+                                    limit=-1, maxcache=0)
+        star_nodes, star_supers = encode_node_columns(star_query.execute(fmt='iter'), 2)
+        isa_nodes, isa_parents = interns.lookup_encoded(isa_nodes), interns.lookup_encoded(isa_parents)
+        star_nodes, star_supers = interns.lookup_encoded(star_nodes), interns.lookup_encoded(star_supers)
+        is_p279 = isa_labels == b'P279'
+        ancestors = ClassAncestors(interns,
+                                   *build_csr(isa_nodes, isa_parents, len(interns)),
+                                   *build_csr(isa_nodes[is_p279], isa_parents[is_p279], len(interns)),
+                                   *build_csr(star_nodes, star_supers, len(interns)))
+        ancestors.save(prefix)
+        self.array_structures.pop(self.CLASS_ANCESTORS_STRUCTURE, None)
+        return self.get_class_ancestors()
+
     def most_specific_subsumers(self, c1, c2):
         """Compute the set of most specific subsumers of 'c1' and 'c2'.
         This will handle 'c1' and 'c2' being equal or one a parent of the other.
+        Uses the precomputed class ancestor structure if available.
+        """
+        ancestors = self.get_class_ancestors()
+        if ancestors is not None:
+            return ancestors.most_specific_subsumers(c1, c2)
+        return self.most_specific_subsumers_via_kypher(c1, c2)
+
+    def most_specific_subsumers_via_kypher(self, c1, c2):
+        """Query-based version of 'most_specific_subsumers' which does not use any precomputed arrays.
         """
         c1_classes = self.get_node_supers_with_parents(c1, fmt='list')
         c2_classes = self.get_node_supers_with_parents(c2, fmt='list')
@@ -497,73 +1158,285 @@ class SimilarityBackend(kapi.KypherApi):
         return mss
 
 
+class BackendPool(object):
+    """Bounded pool of backends that each have their own read-only connection to the graph
+    cache, so concurrent requests don't all have to queue up on a single connection.
+    All pooled backends share loaded embeddings and array structures with the 'primary'
+    backend.  Backends are created on demand up to 'size', after which requests wait for
+    a backend to be returned to the pool.  A pool of size 1 simply uses the primary
+    backend under its lock, which was the original behavior.
+    """
+
+    def __init__(self, primary, size=1):
+        self.primary = primary
+        self.size = max(int(size), 1)
+        # LIFO, so we keep reusing connections whose page caches are warm:
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if create:
+            try:
+                return SimilarityBackend(config=self.get_pooled_config(), loglevel=self.primary.loglevel,
+                                         readonly=True, primary=self.primary)
+            except:
+                # give the slot back, otherwise the pool would permanently shrink:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return self.idle.get()
+
+    def get_pooled_config(self):
+        """Return the configuration for pooled backends.  Each backend has its own query
+        result caches, so we split the configured 'MAX_CACHE_SIZE' among them to keep the
+        total cache memory about the same as that of a single backend.
+        """
+        config = dict(self.primary.config)
+        config['MAX_CACHE_SIZE'] = max(int(self.primary.get_config('MAX_CACHE_SIZE')) // self.size, 1)
+        return config
+
+    def checkin(self, backend):
+        self.idle.put(backend)
+
+    def acquire(self):
+        """Return a context manager for the 'with pool.acquire() as backend:' idiom
+        which gives exclusive access to a backend for the duration of the block.
+        """
+        if self.size == 1:
+            return self.primary
+        return PooledBackend(self)
+
+    def reset(self, close=True):
+        """Drop all idle pooled backends and their graph cache connections, e.g., before or
+        after a process fork.  Use 'close=False' in forked child processes, which must not
+        close connections inherited from their parent.
+        """
+        with self.lock:
+            while True:
+                try:
+                    self.idle.get_nowait().release_sql_store(close=close)
+                except queue.Empty:
+                    break
+            self.created = 0
+
+
+class PooledBackend(object):
+    """Context manager that checks a backend out of a 'BackendPool' and returns it on exit.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.backend = None
+
+    def __enter__(self):
+        self.backend = self.pool.checkout()
+        return self.backend
+
+    def __exit__(self, *_exc):
+        self.pool.checkin(self.backend)
+        self.backend = None
+
+
 class SyncedBackend(object):
     """Synchronized wrapper for low-level requests to the backend.
-    This gives us more fine-grained locking than doing it for top-level requests.
-    This is a stop-gap until fine-grained locking is supported by the Kypher API.
+    Each query is run on a backend checked out of 'pool' for its duration, accessors
+    that only use loaded memory-mapped data are served directly by the primary backend.
     """
     
-    def __init__(self, backend):
+    def __init__(self, backend, pool=None):
         self.backend = backend
+        self.pool = pool or BackendPool(backend)
 
     def get_node_label(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.get_node_label(*args, **kwargs)
+
+    def get_node_label_batch(self, *args, **kwargs):
+        with self.pool.acquire() as backend:
+            return backend.get_node_label_batch(*args, **kwargs)
+
+    def get_node_labels(self, nodes):
+        # this only queries for nodes that are not covered by the precomputed label table:
+        labels, missing = self.backend.lookup_stored_node_labels(nodes)
+        if missing:
+            with self.pool.acquire() as backend:
+                labels.update(backend.get_node_labels(missing))
+        return labels
         
+    # these only query if we don't have the precomputed class count table, so we only sync in that case:
     def get_max_class_count(self, *args, **kwargs):
-        with self.backend as backend:
+        if self.backend.max_class_count is not None:
+            return self.backend.get_max_class_count(*args, **kwargs)
+        with self.pool.acquire() as backend:
             return backend.get_max_class_count(*args, **kwargs)
         
     def get_class_count(self, *args, **kwargs):
-        with self.backend as backend:
+        if self.backend.is_class_count_table_loaded():
+            return self.backend.get_class_count(*args, **kwargs)
+        with self.pool.acquire() as backend:
             return backend.get_class_count(*args, **kwargs)
 
+    def get_class_counts(self, *args, **kwargs):
+        if self.backend.is_class_count_table_loaded():
+            return self.backend.get_class_counts(*args, **kwargs)
+        with self.pool.acquire() as backend:
+            return backend.get_class_counts(*args, **kwargs)
+
+    def get_class_count_batch(self, *args, **kwargs):
+        with self.pool.acquire() as backend:
+            return backend.get_class_count_batch(*args, **kwargs)
+
     def get_class_counts_compact(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.get_class_counts_compact(*args, **kwargs)
 
-    # this one also queries unfortunately, so we need to sync:
-    def get_node_embedding(self, *args, **kwargs):
-        with self.backend as backend:
-            return backend.get_node_embedding(*args, **kwargs)
+    def get_class_counts_compact_batch(self, *args, **kwargs):
+        with self.pool.acquire() as backend:
+            return backend.get_class_counts_compact_batch(*args, **kwargs)
+
+    def get_node_direct_supers_batch(self, *args, **kwargs):
+        with self.pool.acquire() as backend:
+            return backend.get_node_direct_supers_batch(*args, **kwargs)
 
-    def get_node_embeddings(self, *args, **kwargs):
-        with self.backend as backend:
-            return backend.get_node_embeddings(*args, **kwargs)
+    def get_node_emb_numid_and_label_batch(self, *args, **kwargs):
+        with self.pool.acquire() as backend:
+            return backend.get_node_emb_numid_and_label_batch(*args, **kwargs)
+
+    def get_nodes_info(self, *args, **kwargs):
+        with self.pool.acquire() as backend:
+            return backend.get_nodes_info(*args, **kwargs)
+
+    # these only query if we don't have a precomputed row index, so we only sync in that case:
+    def get_node_embedding(self, qnode, embedding_type):
+        if self.backend.is_embedding_store_loaded(embedding_type):
+            return self.backend.get_node_embedding(qnode, embedding_type)
+        with self.pool.acquire() as backend:
+            return backend.get_node_embedding(qnode, embedding_type)
+
+    def get_node_embeddings(self, qnodes, embedding_type):
+        if self.backend.is_embedding_store_loaded(embedding_type):
+            return self.backend.get_node_embeddings(qnodes, embedding_type)
+        with self.pool.acquire() as backend:
+            return backend.get_node_embeddings(qnodes, embedding_type)
+
+    def get_node_embedding_rows(self, qnodes, embedding_type):
+        if self.backend.get_embedding_row_index(embedding_type) is not None:
+            return self.backend.get_node_embedding_rows(qnodes, embedding_type)
+        with self.pool.acquire() as backend:
+            return backend.get_node_embedding_rows(qnodes, embedding_type)
+
+    def get_embedding_row_nodes(self, rows, embedding_type):
+        if self.backend.get_embedding_row_index(embedding_type) is not None:
+            return self.backend.get_embedding_row_nodes(rows, embedding_type)
+        with self.pool.acquire() as backend:
+            return backend.get_embedding_row_nodes(rows, embedding_type)
+
+    def get_embeddings(self, embedding_type):
+        # this only queries the first time to determine the shape of the embeddings array:
+        if self.backend.embeddings.get(embedding_type) is not None:
+            return self.backend.get_embeddings(embedding_type)
+        with self.pool.acquire() as backend:
+            return backend.get_embeddings(embedding_type)
+
+    # these only access configuration and memory-mapped files, so we don't need to sync:
+    def is_normalized_embeddings(self, *args, **kwargs):
+        return self.backend.is_normalized_embeddings(*args, **kwargs)
+
+    def get_embedding_norms(self, *args, **kwargs):
+        return self.backend.get_embedding_norms(*args, **kwargs)
+        
+    def get_node_interns(self, *args, **kwargs):
+        return self.backend.get_node_interns(*args, **kwargs)
+
+    def get_node_label_store(self, *args, **kwargs):
+        return self.backend.get_node_label_store(*args, **kwargs)
+
+    def get_embedding_row_index(self, *args, **kwargs):
+        return self.backend.get_embedding_row_index(*args, **kwargs)
+
+    def has_node_info_table(self, *args, **kwargs):
+        return self.backend.has_node_info_table(*args, **kwargs)
+
+    def has_node_info_labels(self, *args, **kwargs):
+        return self.backend.has_node_info_labels(*args, **kwargs)
+
+    def get_class_feature_matrix(self, *args, **kwargs):
+        return self.backend.get_class_feature_matrix(*args, **kwargs)
         
     def get_node_and_label_from_complex_emb_numid(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.get_node_and_label_from_complex_emb_numid(*args, **kwargs)
         
+    def get_node_and_label_from_emb_numid(self, *args, **kwargs):
+        with self.pool.acquire() as backend:
+            return backend.get_node_and_label_from_emb_numid(*args, **kwargs)
+        
     def most_specific_subsumers_df(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.most_specific_subsumers_df(*args, **kwargs)
     
     def most_specific_subsumers(self, *args, **kwargs):
-        with self.backend as backend:
+        # this only queries if we don't have the precomputed class ancestors:
+        if self.backend.get_class_ancestors() is not None:
+            return self.backend.most_specific_subsumers(*args, **kwargs)
+        with self.pool.acquire() as backend:
             return backend.most_specific_subsumers(*args, **kwargs)
     
     def get_node_node2vec_emb_numid_and_label(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.get_node_node2vec_emb_numid_and_label(*args, **kwargs)
     
     def get_node2vec_embeddings(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.get_node2vec_embeddings(*args, **kwargs)
     
     def get_node_and_label_from_node2vec_emb_numid(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.get_node_and_label_from_node2vec_emb_numid(*args, **kwargs)
     
     def get_node_neighbors(self, *args, **kwargs):
-        with self.backend as backend:
+        with self.pool.acquire() as backend:
             return backend.get_node_neighbors(*args, **kwargs)
 
 
 _backend = SimilarityBackend()
+_pool = BackendPool(_backend, size=_backend.get_config('BACKEND_POOL_SIZE'))
 
 def get_backend():
     return _backend
 
+def get_backend_pool():
+    return _pool
+
 def get_synced_backend():
-    return SyncedBackend(_backend)
+    return SyncedBackend(_backend, _pool)
+
+def preload_backend():
+    """Preload all shared data of the backend before forking worker processes and release
+    all graph cache connections, since SQLite connections must not be carried across a fork.
+    """
+    _backend.preload()
+    _pool.reset()
+    _backend.release_sql_store()
+
+def reset_backend_after_fork():
+    """Drop any graph cache connections inherited by a forked worker process,
+    so the worker will open its own connections on demand.
+    """
+    _pool.reset(close=False)
+    _backend.release_sql_store(close=False)
+
+def get_node_interns():
+    """Return the shared node intern table of the array store or None if it is not available.
+    Node names can be mapped onto their int ids via 'lookup' and back via 'get_nodes'.
+    """
+    return _backend.get_node_interns()
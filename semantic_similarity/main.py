@@ -1,4 +1,5 @@
-from flask import request
+import itertools
+from flask import request, Response, stream_with_context
 from flask_restful import Resource
 from semantic_similarity.semantic_similarity import SemanticSimilarity
 from semantic_similarity.k_nearest_neighbors import FAISS_Index
@@ -31,52 +32,188 @@ class QnodeSimilarity(Resource):
         return self.ss.semantic_similarity(q1, q2, similarity_type)
 
     # restrict the content one can ask about in a single request:
-    file_max_lines = utils.config.get('file_api_max_lines', 100)
+    file_max_lines = utils.config.get('file_api_max_lines', 20000)
+    # similarity types without a vectorized bulk computation are still computed pair by pair:
+    file_unvectorized_max_lines = utils.config.get('file_api_unvectorized_max_lines', 25)
+    # streamed requests are read and scored in chunks and can therefore be much larger:
+    file_stream_max_lines = utils.config.get('file_api_stream_max_lines', 10000000)
+    file_stream_chunk_size = utils.config.get('file_api_stream_chunk_size', 10000)
+
+    stream_formats = {
+        'ndjson': 'application/x-ndjson',
+        'tsv': 'text/tab-separated-values',
+    }
+    # columnar formats are serialized via pyarrow which is only imported when requested:
+    columnar_formats = {
+        'arrow': 'application/vnd.apache.arrow.stream',
+        'parquet': 'application/vnd.apache.parquet',
+    }
+    output_formats = {'json': 'application/json', **stream_formats, **columnar_formats}
 
     def post(self):
         column1 = request.args.get('column1', "q1")
         column2 = request.args.get('column2', "q2")
         add_labels = request.args.get('add_labels', "true").lower() == 'true'
         file_format = request.args.get('file_type', "tsv")
+        output_format = request.args.get('output_format', None) or self.negotiate_output_format()
         sim_types = request.args.get('similarity_types', "all").split(',')
         sim_types = [st for st in self.valid_similarity_types if st in sim_types or 'all' in sim_types]
 
         input_file = request.files.get('file', None)
         if input_file is None:
             return {'error': 'no file provided'}
+        if output_format not in self.output_formats:
+            return {'error': f"output_format should be one of {list(self.output_formats.keys())}"}
 
-        if file_format == 'tsv':
-            df = pd.read_csv(input_file, dtype=object, sep='\t')
-        else:
-            df = pd.read_csv(input_file, dtype=object)
+        if output_format in self.stream_formats:
+            # we read and check the first chunk before we start the response, since once
+            # streaming has started we can only report errors by truncating the output:
+            chunks = self.read_input_file(input_file, file_format, chunksize=self.file_stream_chunk_size)
+            first_chunk = next(chunks, None)
+            error = self.check_input_columns(first_chunk, column1, column2)
+            if error:
+                return error
+            chunks = itertools.chain([first_chunk], chunks)
+            max_lines = self.get_max_lines(sim_types, self.file_stream_max_lines)
+            rows = self.stream_scores(chunks, column1, column2, sim_types, add_labels, output_format, max_lines)
+            return Response(stream_with_context(rows), mimetype=self.stream_formats[output_format])
 
-        df.fillna('', inplace=True)
+        df = self.read_input_file(input_file, file_format)
+        error = self.check_input_columns(df, column1, column2)
+        if error:
+            return error
         if self.debug_requests:
             print(f'QnodeSimilarity.post: {sim_types} {df}')
 
-        qnode_truples = list(zip(df[column1], df[column2]))
-        r = []
-        for i, qnode_truple in enumerate(qnode_truples):
-            if i >= self.file_max_lines:
-                break
-            q1 = qnode_truple[0]
-            q2 = qnode_truple[1]
-            scores = {
-                column1: q1,
-                column2: q2,
-            }
-            for sim_type in sim_types:
-                _ = self.ss.semantic_similarity(q1, q2, sim_type)
-                ok = 'error' not in _
-                scores[sim_type] = _['similarity'] if ok else ''
-                if add_labels:
-                    scores[f'{column1}_label'] = _.get('q1_label')
-                    scores[f'{column2}_label'] = _.get('q2_label')
-            r.append(scores)
-
-        rdf = pd.DataFrame(r)
+        max_lines = self.get_max_lines(sim_types, self.file_max_lines)
+        rdf = self.ss.score_pairs(df.iloc[:max_lines], column1, column2, sim_types, add_labels)
+        if output_format in self.columnar_formats:
+            data = self.serialize_columnar(rdf, sim_types, output_format)
+            return Response(data, mimetype=self.columnar_formats[output_format])
         # TO DO: streamline return type, since this generates a string instead of a dict:
-        return df.merge(rdf, on=[column1, column2]).to_json(orient='records')
+        return rdf.to_json(orient='records')
+
+    def negotiate_output_format(self):
+        """Map the request's Accept header onto one of our output formats, where 'json'
+        is preferred for wildcards and is also the default if nothing matches.
+        """
+        mimetype = request.accept_mimetypes.best_match(list(self.output_formats.values()), 'application/json')
+        for output_format, format_mimetype in self.output_formats.items():
+            if mimetype == format_mimetype:
+                return output_format
+        return 'json'
+
+    def serialize_columnar(self, rdf, sim_types, output_format):
+        """Serialize the result frame 'rdf' to Arrow IPC stream or Parquet bytes.  Missing
+        similarities are encoded as nulls so the similarity columns can be typed as floats.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        rdf = rdf.copy()
+        for sim_type in sim_types:
+            rdf[sim_type] = pd.to_numeric(rdf[sim_type], errors='coerce')
+        table = pa.Table.from_pandas(rdf, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        if output_format == 'arrow':
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+        else:
+            pq.write_table(table, sink)
+        return sink.getvalue().to_pybytes()
+
+    def read_input_file(self, input_file, file_format, chunksize=None):
+        """Read 'input_file' into a data frame, or into an iterator of data frames
+        with at most 'chunksize' rows each if 'chunksize' is not None.
+        """
+        sep = '\t' if file_format == 'tsv' else ','
+        df = pd.read_csv(input_file, dtype=object, sep=sep, keep_default_na=False, chunksize=chunksize)
+        return df
+
+    def check_input_columns(self, df, column1, column2):
+        """Return an error if the input frame 'df' does not have the node columns
+        'column1' and 'column2', otherwise None.
+        """
+        columns = [] if df is None else list(df.columns)
+        missing = [column for column in (column1, column2) if column not in columns]
+        if missing:
+            return {'error': f"input file is missing the node column(s) {missing}"}
+        return None
+
+    def get_max_lines(self, sim_types, max_lines):
+        """Return the number of input lines to score for 'sim_types', which is 'max_lines'
+        unless one of them has no vectorized bulk computation.
+        """
+        if any(st not in self.ss.BATCHED_SIMILARITY_TYPES for st in sim_types):
+            return min(max_lines, self.file_unvectorized_max_lines)
+        return max_lines
+
+    def stream_scores(self, chunks, column1, column2, sim_types, add_labels, output_format, max_lines):
+        """Generate serialized result rows in 'output_format' for each input chunk as soon
+        as it has been scored, so memory stays bounded by the chunk size.  At most 'max_lines'
+        input lines are scored.
+        """
+        nlines = 0
+        for i, df in enumerate(chunks):
+            if nlines >= max_lines:
+                break
+            df = df.iloc[:max_lines - nlines]
+            nlines += len(df)
+            if self.debug_requests:
+                print(f'QnodeSimilarity.post: streaming chunk {i} with {len(df)} rows')
+            rdf = self.ss.score_pairs(df, column1, column2, sim_types, add_labels)
+            if output_format == 'ndjson':
+                # older pandas versions omit the final newline:
+                if len(rdf) > 0:
+                    yield rdf.to_json(orient='records', lines=True).rstrip('\n') + '\n'
+            else:
+                yield rdf.to_csv(sep='\t', index=False, header=(i == 0))
+
+
+class PairSimilarity(Resource):
+    """JSON bulk interface which takes parallel arrays of node pairs and returns
+    parallel arrays of labels and scores, one per requested similarity type.
+    """
+    ss = SemanticSimilarity()
+    valid_similarity_types = list(ss.CONFIGURED_SIMILARITY_TYPES.keys())
+    utils = Utility()
+    debug_requests = utils.config.get('debug_requests', False)
+
+    # restrict the content one can ask about in a single request:
+    pairs_max = utils.config.get('pairs_api_max_pairs', 20000)
+
+    def post(self):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return {'error': "request body should be a JSON object with 'q1' and 'q2' node arrays"}
+        q1s = body.get('q1', None)
+        q2s = body.get('q2', None)
+        if not isinstance(q1s, list) or not isinstance(q2s, list) or len(q1s) != len(q2s):
+            return {'error': "'q1' and 'q2' should be node arrays of the same length"}
+        if len(q1s) > self.pairs_max:
+            return {'error': f"at most {self.pairs_max} pairs can be compared in a single request"}
+
+        sim_types = body.get('similarity_types', ['all'])
+        if isinstance(sim_types, str):
+            sim_types = sim_types.split(',')
+        for sim_type in sim_types:
+            if sim_type != 'all' and sim_type not in self.valid_similarity_types:
+                return {'error': f"similarity_type should be one of {self.valid_similarity_types}"}
+        sim_types = [st for st in self.valid_similarity_types if st in sim_types or 'all' in sim_types]
+        add_labels = body.get('add_labels', True)
+
+        if self.debug_requests:
+            print(f'PairSimilarity.post: {sim_types} {len(q1s)} pairs')
+
+        pairs = list(zip([str(q) for q in q1s], [str(q) for q in q2s]))
+        scores = self.ss.semantic_similarities(pairs, sim_types)
+        result = {'q1': q1s, 'q2': q2s}
+        if add_labels:
+            result['q1_label'] = scores['q1_label']
+            result['q2_label'] = scores['q2_label']
+        # missing similarities are returned as nulls instead of the file API's empty strings:
+        result['similarities'] = {st: [None if x == '' else x for x in scores[st]] for st in sim_types}
+        return result
 
 
 class NN(Resource):
@@ -90,6 +227,7 @@ class NN(Resource):
 
     # restrict the content one can ask about in a single request:
     nn_api_max_k = utils.config.get('nn_api_max_k', 100)
+    nn_api_max_qnodes = utils.config.get('nn_api_max_qnodes', 10000)
     debug_requests = utils.config.get('debug_requests', False)
 
     def get(self):
@@ -111,6 +249,35 @@ class NN(Resource):
         else:
             return self.ss.get_most_similar(qnode, similarity_type, topn=k) or []
 
+    def post(self):
+        """Batched version of 'get' which takes a JSON object with a list of 'qnodes' and
+        returns a dict mapping each qnode to its list of neighbors.
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('qnodes', None), list):
+            return {'error': "request body should be a JSON object with a 'qnodes' array"}
+        qnodes = [str(q) for q in body['qnodes']]
+        if len(qnodes) > self.nn_api_max_qnodes:
+            return {'error': f"at most {self.nn_api_max_qnodes} qnodes can be searched in a single request"}
+        similarity_type = body.get('similarity_type', self.valid_nn_similarity_types[0])
+        if similarity_type not in self.valid_nn_similarity_types:
+            if similarity_type not in self.valid_similarity_types:
+                return {'error': f"{similarity_type} is not a valid similarity type"}
+            return {'error': f"{similarity_type} similarity is not currently supported for nearest neighbor requests"}
+
+        if self.debug_requests:
+            print(f'NN.post: {len(qnodes)} qnodes {similarity_type}')
+
+        k = body.get('k', 5)
+        if isinstance(k, bool) or not isinstance(k, (int, str)) or not str(k).strip().isdigit() or int(k) < 1:
+            return {'error': "'k' should be a positive integer"}
+        k = min(int(k), self.nn_api_max_k)
+        if self.api_version_1:
+            results = self.fi.get_neighbors_batch(qnodes, k=k)
+        else:
+            results = self.ss.get_most_similar_batch(qnodes, similarity_type, topn=k) or [[] for q in qnodes]
+        return dict(zip(qnodes, results))
+
 # class Paths(Resource):
 #     kgp = KGTKPaths()
 #
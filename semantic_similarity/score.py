@@ -0,0 +1,155 @@
+"""
+Score a (possibly huge) TSV file of node pairs offline with a local similarity
+backend, without going through the web API.  This needs to be run from the
+repository root, since that is where the configuration gets loaded from, for
+example:
+
+    python -m semantic_similarity.score pairs.tsv -o scores.tsv --similarity-types class complex
+
+The input is read in chunks which are scored in bulk by a pool of worker
+processes.  All embeddings and array structures are loaded once before the
+workers are forked, so they are shared by all of them via memory mapping.
+Scored chunks are appended to the output in input order, and a checkpoint is
+written after each one, so an interrupted run can be continued with '--resume'.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import collections
+import multiprocessing as mp
+
+import pandas as pd
+
+import semantic_similarity.kypher as kypher
+from semantic_similarity.semantic_similarity import SemanticSimilarity
+
+
+parser = argparse.ArgumentParser(prog='python -m semantic_similarity.score')
+parser.add_argument('input_file', metavar='INPUT',
+                    help='TSV file with a header and node pair columns')
+parser.add_argument('-o', '--output-file', metavar='OUTPUT', required=True,
+                    help='TSV file to write the input columns plus similarity columns to')
+parser.add_argument('--similarity-types', nargs='*', metavar='TYPE',
+                    choices=list(SemanticSimilarity.CONFIGURED_SIMILARITY_TYPES.keys()),
+                    help='similarity types to compute (default: all)')
+parser.add_argument('--column1', default='q1', help='name of the first node column (default: q1)')
+parser.add_argument('--column2', default='q2', help='name of the second node column (default: q2)')
+parser.add_argument('--no-labels', action='store_true', help='do not add node label columns')
+parser.add_argument('--chunk-size', type=int, default=10000,
+                    help='number of pairs scored in bulk per task (default: 10000)')
+parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                    help='number of worker processes (default: number of CPUs)')
+parser.add_argument('--resume', action='store_true',
+                    help='continue an interrupted run from its checkpoint')
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+def get_checkpoint_file(output_file):
+    return output_file + '.checkpoint'
+
+def load_checkpoint(output_file):
+    checkpoint_file = get_checkpoint_file(output_file)
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r') as inp:
+            return json.load(inp)
+    return None
+
+def save_checkpoint(output_file, checkpoint):
+    # write and rename so we never end up with a partial checkpoint:
+    checkpoint_file = get_checkpoint_file(output_file)
+    with open(checkpoint_file + '.tmp', 'w') as out:
+        json.dump(checkpoint, out)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+# worker process state, initialized once per process by 'init_worker':
+_scorer = None
+_options = None
+
+def init_worker(options):
+    global _scorer, _options
+    kypher.reset_backend_after_fork()
+    _scorer = SemanticSimilarity()
+    _options = options
+
+def score_chunk(df):
+    """Score the pairs of data frame 'df' and return its serialized TSV rows.
+    """
+    column1, column2, sim_types, add_labels = _options
+    df = _scorer.score_pairs(df, column1, column2, sim_types, add_labels)
+    return len(df), df.to_csv(sep='\t', index=False, header=False)
+
+def get_output_header(columns, column1, column2, sim_types, add_labels):
+    columns = list(columns)
+    if add_labels:
+        columns += [f'{column1}_label', f'{column2}_label']
+    return '\t'.join(columns + sim_types) + '\n'
+
+def score_file(args):
+    sim_types = args.similarity_types or list(SemanticSimilarity.CONFIGURED_SIMILARITY_TYPES.keys())
+    add_labels = not args.no_labels
+    options = (args.column1, args.column2, sim_types, add_labels)
+
+    checkpoint = load_checkpoint(args.output_file) if args.resume else None
+    if args.resume and checkpoint is None and os.path.exists(args.output_file):
+        raise Exception(f'cannot resume {args.output_file} which has no checkpoint, it might already be complete')
+    if not args.resume and os.path.exists(get_checkpoint_file(args.output_file)):
+        raise Exception(f'{args.output_file} has a checkpoint of an interrupted run, use --resume to continue it')
+    if checkpoint is not None:
+        if checkpoint['input'] != os.path.abspath(args.input_file) or checkpoint['options'] != list(options):
+            raise Exception(f'checkpoint of {args.output_file} was written for a different input or options')
+        # drop any output written after the last checkpoint:
+        out = open(args.output_file, 'r+')
+        out.truncate(checkpoint['offset'])
+        out.seek(checkpoint['offset'])
+        log(f'Resuming after {checkpoint["rows"]} scored pairs')
+    else:
+        checkpoint = {'input': os.path.abspath(args.input_file), 'options': list(options), 'rows': 0, 'offset': 0}
+        out = open(args.output_file, 'w')
+
+    if checkpoint['offset'] == 0:
+        columns = pd.read_csv(args.input_file, dtype=object, sep='\t', nrows=0).columns
+        out.write(get_output_header(columns, *options))
+        checkpoint['offset'] = out.tell()
+        save_checkpoint(args.output_file, checkpoint)
+    chunks = pd.read_csv(args.input_file, dtype=object, sep='\t', keep_default_na=False,
+                         chunksize=args.chunk_size, skiprows=range(1, checkpoint['rows'] + 1))
+
+    # load all shared data before forking, so workers share it instead of loading their own copies:
+    kypher.preload_backend()
+    start = time.time()
+    nrows = checkpoint['rows']
+    with mp.get_context('fork').Pool(args.processes, initializer=init_worker, initargs=(options,)) as pool:
+        # we submit chunks ourselves instead of using 'imap', since that would read ahead
+        # the whole input; this way at most 'max_pending' chunks are in memory at a time:
+        pending = collections.deque()
+        max_pending = 2 * args.processes
+        nchunks = 0
+        for df in itertools.chain(chunks, [None]):
+            if df is not None:
+                pending.append(pool.apply_async(score_chunk, (df,)))
+            while pending and (len(pending) >= max_pending or df is None):
+                chunk_rows, output = pending.popleft().get()
+                out.write(output)
+                out.flush()
+                nrows += chunk_rows
+                nchunks += 1
+                checkpoint['rows'] = nrows
+                checkpoint['offset'] = out.tell()
+                save_checkpoint(args.output_file, checkpoint)
+                if nchunks % 10 == 0:
+                    log(f'Scored {nrows} pairs ({nrows / max(time.time() - start, 1e-3):.0f} pairs/sec)')
+    out.close()
+    log(f'Scored {nrows} pairs in total')
+    os.remove(get_checkpoint_file(args.output_file))
+
+
+if __name__ == '__main__':
+    score_file(parser.parse_args())
@@ -4,6 +4,7 @@ import json
 from semantic_similarity.utility import Utility, cosine_similarity
 import semantic_similarity.kypher as kypher
 import semantic_similarity.similarity_measures as sm
+from semantic_similarity.batching import MicroBatcher
 import os
 
 if 'KGTK_SIMILARITY_CONFIG' in os.environ and os.environ['KGTK_SIMILARITY_CONFIG'] is not None:
@@ -21,14 +22,64 @@ class SemanticSimilarity(object):
         'jc': sm.JiangConrathSimilarity(),
         'topsim': sm.TopSimSimilarity_2(),
     }
+    # 'complex' is always listed, other embedding types only if they have a configured FAISS index:
     CONFIGURED_NN_SIMILARITY_TYPES = {
         'complex': sm.ComplExSimilarity(),
+        **({'transe': sm.TransESimilarity()} if sm.TransESimilarity.has_faiss_index() else {}),
+        **({'text': sm.TextSimilarity()} if sm.TextSimilarity.has_faiss_index() else {}),
     }
 
+    # micro batchers shared by all instances, one per similarity type:
+    _batchers = {}
+    # only these have vectorized bulk computations, batching others would just serialize them:
+    BATCHED_SIMILARITY_TYPES = ('complex', 'transe', 'text', 'class')
+
     def __init__(self):
         self.config = config
         self.util = Utility()
         self.backend = kypher.get_backend()
+        # collecting concurrent single-pair requests into batches is disabled if this is 0:
+        self.batch_max_wait = self.util.config.get('pairwise_batch_max_wait_ms', 0) / 1000.0
+        self.batch_max_size = self.util.config.get('pairwise_batch_max_size', 1000)
+
+    def get_batcher(self, similarity_type):
+        if self.batch_max_wait <= 0 or similarity_type not in self.BATCHED_SIMILARITY_TYPES:
+            return None
+        batcher = self._batchers.get(similarity_type)
+        if batcher is None:
+            batcher = MicroBatcher(self.CONFIGURED_SIMILARITY_TYPES[similarity_type],
+                                   max_wait=self.batch_max_wait, max_batch=self.batch_max_size)
+            batcher = self._batchers.setdefault(similarity_type, batcher)
+        return batcher
+
+    def compute_similarity(self, q1: str, q2: str, similarity_type: str):
+        """Compute the similarity of 'q1' and 'q2', batched with concurrent requests if enabled.
+        """
+        batcher = self.get_batcher(similarity_type)
+        if batcher is not None:
+            return batcher.compute_similarity(q1, q2)
+        return self.CONFIGURED_SIMILARITY_TYPES[similarity_type].compute_similarity(q1, q2)
+
+    def get_detail_fields(self, similarity_types):
+        """Return the node detail fields needed to check and label pairs for 'similarity_types',
+        which is the respective embedding for embedding types and the classes for all others.
+        """
+        fields = set(['label'])
+        for similarity_type in similarity_types:
+            fields.add(similarity_type if similarity_type in ('complex', 'text', 'transe') else 'class')
+        return fields
+
+    def is_present_node(self, info, similarity_type):
+        """Return True if node details 'info' show that the node is present for 'similarity_type',
+        which requires the respective embedding for embedding types and a label or classes for
+        all others.  This only looks at the fields selected by 'get_detail_fields', so it gives
+        the same answer no matter which other fields happen to be fetched or cached.
+        """
+        if not info:
+            return False
+        if similarity_type in ('complex', 'text', 'transe'):
+            return info.get(similarity_type, None) is not None
+        return info.get('class', None) is not None or bool(info.get('label', None))
 
     def semantic_similarity(self, q1: str, q2: str, similarity_type: str):
 
@@ -40,35 +91,85 @@ class SemanticSimilarity(object):
         # this mirrors the original missing node error detection:
         # NOTE: it is possible to only get some of the embeddings, e.g., for Q17156448 we get text
         # but not complex/transe, plus there are about 14M fewer text embeddings than complex/transe:
-        qnodes_dict = self.util.get_qnode_details([q1, q2])
+        qnodes_dict = self.util.get_qnode_details([q1, q2], fields=self.get_detail_fields([similarity_type]))
         q1_result = qnodes_dict.get(q1, None)
         q2_result = qnodes_dict.get(q2, None)
-        is_emb_sim = similarity_type in ('complex', 'text', 'transe')
-        if not q1_result or is_emb_sim and q1_result.get(similarity_type, None) is None:
+        if not self.is_present_node(q1_result, similarity_type):
             return {'error': f"The qnode: {q1} is not present in DWD"}
 
-        if not q2_result or is_emb_sim and q2_result.get(similarity_type, None) is None:
+        if not self.is_present_node(q2_result, similarity_type):
             return {'error': f"The qnode: {q2} is not present in DWD"}
 
         # we use the labels from the ES instance, since they don't contain language tags:
         return {
-            'similarity': sim.compute_similarity(q1, q2),
+            'similarity': self.compute_similarity(q1, q2, similarity_type),
             'q1': q1,
             'q1_label': q1_result.get('label', ''),
             'q2': q2,
             'q2_label': q2_result.get('label', ''),
         }
 
+    def semantic_similarities(self, pairs, similarity_types):
+        """Bulk version of 'semantic_similarity' for a list of node 'pairs' and 'similarity_types'.
+        Node details are fetched once for all nodes and each similarity measure is called once
+        on the list of unique valid pairs.  Returns a dict with the lists 'q1_label' and 'q2_label'
+        and a list of similarities for each of 'similarity_types', all parallel to 'pairs',
+        where pairs with missing nodes get a similarity of '' and missing nodes an empty label.
+        """
+        unique_pairs = list(dict.fromkeys(pairs))
+        qnodes = list(set([p[0] for p in unique_pairs]).union([p[1] for p in unique_pairs]))
+        qnodes_dict = self.util.get_qnode_details(qnodes, fields=self.get_detail_fields(similarity_types))
+        results = {
+            'q1_label': [qnodes_dict.get(q1, {}).get('label', '') for q1, q2 in pairs],
+            'q2_label': [qnodes_dict.get(q2, {}).get('label', '') for q1, q2 in pairs],
+        }
+        for similarity_type in similarity_types:
+            sim = self.CONFIGURED_SIMILARITY_TYPES[similarity_type]
+            # this mirrors the missing node error detection of 'semantic_similarity':
+            valid_nodes = set([qnode for qnode, info in qnodes_dict.items()
+                               if self.is_present_node(info, similarity_type)])
+            valid_pairs = [(q1, q2) for q1, q2 in unique_pairs if q1 in valid_nodes and q2 in valid_nodes]
+            similarities = dict(zip(valid_pairs, sim.compute_pairwise_similarities(valid_pairs) if valid_pairs else []))
+            results[similarity_type] = [similarities.get(pair, '') for pair in pairs]
+        return results
+
+    def score_pairs(self, df, column1, column2, similarity_types, add_labels=True):
+        """Return a copy of data frame 'df' with label columns (if 'add_labels') and a column
+        for each of 'similarity_types' added for the node pairs in 'column1' and 'column2'.
+        The whole frame is computed in bulk via 'semantic_similarities'.
+        """
+        pairs = list(zip(df[column1], df[column2]))
+        scores = self.semantic_similarities(pairs, similarity_types)
+        df = df.copy()
+        if add_labels:
+            df[f'{column1}_label'] = scores['q1_label']
+            df[f'{column2}_label'] = scores['q2_label']
+        for similarity_type in similarity_types:
+            df[similarity_type] = scores[similarity_type]
+        return df
+
     def get_most_similar(self, qnode: str, similarity_type: str, topn: int = 20):
         sim = self.CONFIGURED_NN_SIMILARITY_TYPES.get(similarity_type)
         if not sim:
             return None
-        elif similarity_type == 'complex':
-            # supply poolsize that makes sense for 'complex':
+        elif isinstance(sim, sm.EmbeddingSimilarity):
+            # supply poolsize that makes sense for embedding indexes:
             return sim.get_most_similar(qnode, topn=topn, poolsize=max(2 * topn, 100))
         else:
             return sim.get_most_similar(qnode, topn=topn)
 
+    def get_most_similar_batch(self, qnodes, similarity_type: str, topn: int = 20):
+        """Batched version of 'get_most_similar' returning a list of results parallel to 'qnodes'.
+        """
+        sim = self.CONFIGURED_NN_SIMILARITY_TYPES.get(similarity_type)
+        if not sim:
+            return None
+        elif isinstance(sim, sm.EmbeddingSimilarity):
+            # supply poolsize that makes sense for embedding indexes:
+            return sim.get_most_similar_batch(qnodes, topn=topn, poolsize=max(2 * topn, 100))
+        else:
+            return sim.get_most_similar_batch(qnodes, topn=topn)
+
 
 class SemanticSimilarity_v1(object):
     """Original semantic similarity entry point.  We keep this for now just in case
@@ -88,7 +189,7 @@ class SemanticSimilarity_v1(object):
         if embeddings_type == "class":
             return self.compute_class_similarity(q1, q2)
         else:
-            qnodes_dict = self.util.get_qnode_details([q1, q2])
+            qnodes_dict = self.util.get_qnode_details([q1, q2], fields=['label', embeddings_type])
             q1_result = qnodes_dict.get(q1, None)
             q2_result = qnodes_dict.get(q2, None)
             if not q1_result or q1_result.get(embeddings_type, None) is None:
@@ -108,7 +209,7 @@ class SemanticSimilarity_v1(object):
                 }
 
     def compute_class_similarity(self, q1, q2):
-        qnodes_dict = self.util.get_qnode_details([q1, q2])
+        qnodes_dict = self.util.get_qnode_details([q1, q2], fields=['label', 'class'])
         feature_dict, feature_count_dict = self.build_qnode_feature_dict(qnodes_dict)
         normalized_classes_idf = self.normalize_idf_classes(feature_dict, feature_count_dict)
         if q1 in feature_dict and q2 in feature_dict:
@@ -10,7 +10,7 @@ from   functools import lru_cache
 import numpy as np
 import pandas as pd
 
-from   semantic_similarity.utility import Utility, cosine_similarity
+from   semantic_similarity.utility import Utility, cosine_similarity, pairwise_cosine_similarity, node_cosine_similarity
 import semantic_similarity.kypher as kypher
 from   semantic_similarity.k_nearest_neighbors import FAISS_Index
 
@@ -47,34 +47,38 @@ class SimilarityMeasure(object):
         """
         qnodes = set([p[0] for p in pairs])
         qnodes.update([p[1] for p in pairs])
-        qnode_dict = self.util.get_qnode_details(list(qnodes))
+        qnodes = list(qnodes)
+        if not self.api_version_1:
+            # compute directly on the memory-mapped embeddings using their precomputed norms if available:
+            rows = dict(zip(qnodes, self.backend.get_node_embedding_rows(qnodes, self.embedding_type)))
+            idx1 = np.array([rows[q1] for q1, q2 in pairs], dtype=np.int64)
+            idx2 = np.array([rows[q2] for q1, q2 in pairs], dtype=np.int64)
+            sims = pairwise_cosine_similarity(self.backend.get_embeddings(self.embedding_type), idx1, idx2,
+                                              norms=self.backend.get_embedding_norms(self.embedding_type),
+                                              normalized=self.backend.is_normalized_embeddings(self.embedding_type))
+            # map negative similarities which represent anti-correlation of some kind onto 0:
+            return np.maximum(sims, 0.0).tolist()
+
+        qnode_dict = self.util.get_qnode_details(qnodes, fields=[self.embedding_type])
         # this is slightly more complex, because we want to perform the distance
-        # computations in a single efficient vectorized call instead of one-by-one:
-        emb_shape = None
-        for info in qnode_dict.values():
+        # computations in a single efficient vectorized call instead of one-by-one;
+        # we stack the embeddings of all distinct nodes into one float32 matrix and
+        # represent pairs as row indices into it, with -1 marking missing embeddings:
+        node_rows = {}
+        embs = []
+        for qnode, info in qnode_dict.items():
             emb = info.get(self.embedding_type)
             if emb is not None:
-                emb_shape = emb.shape
-                break
-        if emb_shape is None:
+                node_rows[qnode] = len(embs)
+                embs.append(emb)
+        if len(embs) == 0:
             return [0.0] * len(pairs)
-        oppo1, oppo2 = np.ones(emb_shape), np.ones(emb_shape) * -1
-        emb1s, emb2s = [], []
-        for q1, q2 in pairs:
-            if q1 in qnode_dict and q2 in qnode_dict:
-                emb1 = qnode_dict[q1].get(self.embedding_type)
-                emb2 = qnode_dict[q2].get(self.embedding_type)
-                if emb1 is not None and emb2 is not None:
-                    emb1s.append(emb1)
-                    emb2s.append(emb2)
-                    continue
-            # force 0.0 similarity for this pair with vectors in opposite directions:
-            emb1s.append(oppo1)
-            emb2s.append(oppo2)
+        embs = np.array(embs, dtype=np.float32)
+        idx1 = np.array([node_rows.get(q1, -1) for q1, q2 in pairs], dtype=np.int64)
+        idx2 = np.array([node_rows.get(q2, -1) for q1, q2 in pairs], dtype=np.int64)
+        sims = pairwise_cosine_similarity(embs, idx1, idx2)
         # map negative similarities which represent anti-correlation of some kind onto 0:
-        # TO DO: clean up float coercion
-        sims = [max(float(cosine_similarity(e1, e2)[0][0]), 0.0) for e1, e2 in zip(emb1s, emb2s)]
-        return sims
+        return np.maximum(sims, 0.0).tolist()
 
     def compute_node_similarities(self, node, others):
         """Compute similarities between 'node' and 'others' and return the result as a list.
@@ -92,17 +96,12 @@ class SimilarityMeasure(object):
             return self.compute_pairwise_embedding_similarities([(node, other) for other in others])
         if not others:
             return []
-        nodeemb = self.backend.get_node_embedding(node, self.embedding_type)
-        if nodeemb is None:
-            return [0.0] * len(others)
-        otherembs = self.backend.get_node_embeddings(others, self.embedding_type)
-        # if emb is undefined, force a negative sim by using -nodeemb:
-        otherembs = [emb if emb is not None else -nodeemb for emb in otherembs]
-        sims = cosine_similarity(nodeemb, np.array(otherembs))[0]
+        rows = self.backend.get_node_embedding_rows([node] + list(others), self.embedding_type)
+        sims = node_cosine_similarity(self.backend.get_embeddings(self.embedding_type), rows[0], rows[1:],
+                                      norms=self.backend.get_embedding_norms(self.embedding_type),
+                                      normalized=self.backend.is_normalized_embeddings(self.embedding_type))
         # map negative similarities which represent anti-correlation of some kind onto 0:
-        # TO DO: clean up float coercion
-        sims = [max(float(sim), 0.0) for sim in sims]
-        return sims
+        return np.maximum(sims, 0.0).tolist()
     
     def get_most_similar_df(self, c, topn=20):
         return None
@@ -127,24 +126,63 @@ class ClassSimilarity(SimilarityMeasure):
     def compute_pairwise_similarities(self, pairs):
         """Compute similarities over a sequence of pairs and return the result as a list.
         """
+        matrix = None if self.api_version_1 else self.backend.get_class_feature_matrix()
+        if matrix is not None:
+            return self.compute_pairwise_matrix_similarities(matrix, pairs)
+        return self.compute_pairwise_feature_similarities(pairs)
+
+    def compute_pairwise_feature_similarities(self, pairs):
+        """Compute similarities over a sequence of pairs by parsing the class features of
+        each node exactly once for the whole batch instead of once per pair as done by
+        'compute_class_similarity'.  The normalized IDF similarity of a pair with class sets
+        A and B is 2*idf(A & B) / (idf(A) + idf(B)), where idf(X) is the sum of the class IDFs
+        of X, so we only need to compute the IDF sums of each node once and then intersect.
+        """
         qnodes = set([p[0] for p in pairs])
         qnodes.update([p[1] for p in pairs])
-        qnode_dict = self.util.get_qnode_details(list(qnodes))
+        qnode_dict = self.util.get_qnode_details(list(qnodes), fields=['class'])
+        feature_dict, feature_count_dict = self.build_qnode_feature_dict(qnode_dict)
+        classes_idf = self.calculate_idf_features(feature_count_dict)
+        node_classes = {}
+        node_idf_sums = {}
+        for qnode, features in feature_dict.items():
+            node_classes[qnode] = set(features)
+            node_idf_sums[qnode] = sum([classes_idf[c] for c in node_classes[qnode]])
+
         similarities = []
         for q1, q2 in pairs:
             sim = 0.0
-            if q1 in qnode_dict and q2 in qnode_dict:
-                # just extract the sim-value and discard the info components such as labels;
-                # NOTE that we can get empty strings here, thus the 'or':
-                sim = self.compute_class_similarity(q1, q2).get('similarity') or 0.0
+            if q1 in node_classes and q2 in node_classes:
+                idf_sum = node_idf_sums[q1] + node_idf_sums[q2]
+                if q1 == q2:
+                    sim = 1.0 if idf_sum != 0.0 else 0.0
+                elif idf_sum != 0.0:
+                    q1_q2_intersection = node_classes[q1].intersection(node_classes[q2])
+                    sim = 2.0 * sum([classes_idf[c] for c in q1_q2_intersection]) / idf_sum
             # guard against negative similiarities:
             sim = max(sim, 0.0)
             similarities.append(sim)
         return similarities
 
+    def compute_pairwise_matrix_similarities(self, matrix, pairs):
+        """Compute similarities over a sequence of pairs using the precomputed sparse
+        node-to-classes 'matrix'.  The normalized IDF similarity computed by
+        'compute_class_similarity' is twice the sum of IDFs of the classes shared by
+        both nodes divided by the sum of the class IDFs of each node, that is,
+        2*idf(A&B) / (idf(A) + idf(B)), which is what 'ClassFeatureMatrix.pairwise_similarities'
+        computes in bulk.  The factor 2 is what makes this equal the normalized IDF value.
+        """
+        if len(pairs) == 0:
+            return []
+        qnodes = list(set([p[0] for p in pairs]).union([p[1] for p in pairs]))
+        rows = dict(zip(qnodes, matrix.get_rows(qnodes)))
+        rows1 = np.array([rows[q1] for q1, q2 in pairs], dtype=np.int64)
+        rows2 = np.array([rows[q2] for q1, q2 in pairs], dtype=np.int64)
+        return np.maximum(matrix.pairwise_similarities(rows1, rows2), 0.0).tolist()
+
     def compute_class_similarity(self, q1, q2):
         # Original version of SemanticSimilarity.compute_class_similarity
-        qnodes_dict = self.util.get_qnode_details([q1, q2])
+        qnodes_dict = self.util.get_qnode_details([q1, q2], fields=['label', 'class'])
         feature_dict, feature_count_dict = self.build_qnode_feature_dict(qnodes_dict)
         normalized_classes_idf = self.normalize_idf_classes(feature_dict, feature_count_dict)
         if q1 in feature_dict and q2 in feature_dict:
@@ -184,10 +222,11 @@ class ClassSimilarity(SimilarityMeasure):
                     feature_count_dict[vals[0]] = float(vals[1])
                 if qnode not in feature_val:
                     feature_val.append(qnode)
-                if qnode not in feature_count_dict:
-                    feature_count_dict[qnode] = self.backend.get_class_count(qnode, 1.0)
                 feature_dict[qnode] = feature_val
 
+        # look up any missing class counts of the nodes themselves in bulk:
+        missing = [qnode for qnode in feature_dict if qnode not in feature_count_dict]
+        feature_count_dict.update(zip(missing, self.backend.get_class_counts(missing, 1.0)))
         return feature_dict, feature_count_dict
 
     def normalize_idf_classes(self, feature_dict, feature_count_dict):
@@ -273,8 +312,7 @@ class JiangConrathSimilarity(SimilarityMeasure):
         mss = self.backend.most_specific_subsumers_df(c1, c2)
         cols = ('super', 'label', 'count', 'dist', 'sim', 'agg_dist', 'agg_sim', 'max_sim')
         N = float(self.backend.get_max_class_count())
-        c1_count = self.backend.get_class_count(c1, 1)
-        c2_count = self.backend.get_class_count(c2, 1)
+        c1_count, c2_count = self.backend.get_class_counts([c1, c2], 1)
         term2 = math.log(c1_count / N) + math.log(c2_count / N)
         if len(mss) == 0:
             return pd.DataFrame([[None, '', 0, math.nan, 0.0, 0.0, 0.0, 0.0]], columns=cols)
@@ -287,7 +325,7 @@ class JiangConrathSimilarity(SimilarityMeasure):
         # through the ontology top-node 'entity' which makes sims a bit lower; this
         # also means all immediate children of 'entiy' will have similarity=0:
         max_dist = -term2
-        mss['count'] = mss['super'].apply(lambda row: self.backend.get_class_count(row))
+        mss['count'] = self.backend.get_class_counts(list(mss['super']))
         mss['dist'] = mss['count'].apply(lambda row: 2 * math.log(row / N) - term2)
         mss['sim']  = mss['dist'].apply(lambda row: 1.0 - row / max_dist)
         # fix issues with negative distances due to count problems (e.g., "Q29182" vs. "Q133485"):
@@ -310,10 +348,9 @@ class JiangConrathSimilarity(SimilarityMeasure):
         """Same as 'compute_similarity_df' but do not use Pandas.
         Return the equivalent of max-sim as the sole result.
         """
-        mss = self.backend.most_specific_subsumers(c1, c2)
+        mss = list(self.backend.most_specific_subsumers(c1, c2))
         N = float(self.backend.get_max_class_count())
-        c1_count = self.backend.get_class_count(c1, 1)
-        c2_count = self.backend.get_class_count(c2, 1)
+        c1_count, c2_count = self.backend.get_class_counts([c1, c2], 1)
         term2 = math.log(c1_count / N) + math.log(c2_count / N)
         if len(mss) == 0:
             return 0.0
@@ -326,7 +363,7 @@ class JiangConrathSimilarity(SimilarityMeasure):
         # through the ontology top-node 'entity' which makes sims a bit lower; this
         # also means all immediate children of 'entiy' will have similarity=0:
         max_dist = -term2
-        mss_counts = [self.backend.get_class_count(row) for row in mss]
+        mss_counts = self.backend.get_class_counts(mss)
         # fix issues with negative distances due to count problems (e.g., "Q29182" vs. "Q133485"):
         mss_dists =  [max(2 * math.log(row / N) - term2, 0.0) for row in mss_counts]
         mss_sims  =  [max(1.0 - row / max_dist, 0.0) for row in mss_dists]
@@ -379,49 +416,60 @@ class JiangConrathSimilarity(SimilarityMeasure):
 """
 
 
-class ComplExSimilarity(SimilarityMeasure):
+class EmbeddingSimilarity(SimilarityMeasure):
     """
-    Similarity computations based on ComplEx graph embeddings.
-    Currently these are 100-dimensional.
+    Base class for embedding-based similarity measures whose nearest neighbors
+    are served from a FAISS index over the same embeddings.
     """
-    
-    EMBEDDING_KEY = 'complex'
 
-    # class slot so we only load this once:
-    faiss_index = None
+    EMBEDDING_KEY = None
 
-    def __init__(self, *args, **kwdargs):
-        super().__init__(*args, embedding_type=self.EMBEDDING_KEY, **kwdargs)
+    # class slot so we only load each index once:
+    faiss_indexes = {}
 
     @classmethod
-    def get_faiss_index(self):
-        if self.faiss_index is None:
-            # the first time this takes 20+GB of RAM and some time to load:
-            self.faiss_index = FAISS_Index()
-        return self.faiss_index
+    def has_faiss_index(cls):
+        return FAISS_Index.get_index_file(cls.EMBEDDING_KEY) is not None
 
-    def compute_pairwise_similarities(self, pairs):
-        """Compute similarities over a sequence of pairs and return the result as a list.
-        """
-        return self.compute_pairwise_embedding_similarities(pairs)
+    @classmethod
+    def get_faiss_index(cls):
+        index = cls.faiss_indexes.get(cls.EMBEDDING_KEY)
+        if index is None:
+            # the index is memory-mapped if possible, otherwise this takes 20+GB of RAM the first time:
+            index = FAISS_Index(embedding_type=cls.EMBEDDING_KEY)
+            cls.faiss_indexes[cls.EMBEDDING_KEY] = index
+        return index
 
-    def compute_node_similarities(self, node, others):
-        """Compute similarities between 'node' and 'others' and return the result as a list.
+    def get_most_similar(self, qnode, topn=20, poolsize=None):
+        return self.get_most_similar_batch([qnode], topn=topn, poolsize=poolsize)[0]
+
+    def get_most_similar_batch(self, qnodes, topn=20, poolsize=None):
+        """Batched version of 'get_most_similar' which returns a list of neighbor lists
+        parallel to 'qnodes' computed with a single index search.
         """
-        return self.compute_node_embedding_similarities(node, others)
+        index = self.get_faiss_index()
+        if index.is_cosine_index():
+            # the index scores are the cosine similarities, so no over-fetching or re-scoring is needed:
+            results = index.get_neighbors_batch(qnodes, k=topn)
+            for neighbors in results:
+                for info in neighbors:
+                    info['score'] = float(info['score']) # coerce numpy float32s
+                    info['sim'] = max(info['score'], 0.0)
+            return results
 
-    def get_most_similar(self, qnode, topn=20, poolsize=None):
         # these include raw scores from the index:
         poolsize = poolsize or topn * 5
-        neighbors = self.get_faiss_index().get_neighbors(qnode, k=poolsize)
-        
+        results = index.get_neighbors_batch(qnodes, k=poolsize)
+        return [self.rerank_neighbors(qnode, neighbors, topn) for qnode, neighbors in zip(qnodes, results)]
+
+    def rerank_neighbors(self, qnode, neighbors, topn):
         # NOTE: the scores from the index lookup and associated ordering correspond to
         # the FAISS L2 metric we currently use for training, which does not give the same
         # ranking as cosine similarity.  For now we compute the actual cosine similarities
         # here, but in order to get a good top-k set of neighbors, a significantly larger
         # set of 'poolsize' has to be extracted in order to get good coverage
-        # TO DO: use cosine similarity during training of the index (which requires normalization
-        # of the embedding vectors), since even with large poolsize we are missing stuff
+        # An index built with 'scripts/build_faiss_index.py' uses cosine similarity and is
+        # handled by 'get_most_similar_batch', since even with large poolsize we are missing stuff here.
         similarities = self.compute_node_embedding_similarities(qnode, [n['qnode'] for n in neighbors])
         for sim, info in zip(similarities, neighbors):
             info['sim'] = sim
@@ -429,6 +477,28 @@ class ComplExSimilarity(SimilarityMeasure):
         neighbors.sort(key=lambda i: i['sim'], reverse=True)
         return neighbors[0:topn]
 
+
+class ComplExSimilarity(EmbeddingSimilarity):
+    """
+    Similarity computations based on ComplEx graph embeddings.
+    Currently these are 100-dimensional.
+    """
+    
+    EMBEDDING_KEY = 'complex'
+
+    def __init__(self, *args, **kwdargs):
+        super().__init__(*args, embedding_type=self.EMBEDDING_KEY, **kwdargs)
+
+    def compute_pairwise_similarities(self, pairs):
+        """Compute similarities over a sequence of pairs and return the result as a list.
+        """
+        return self.compute_pairwise_embedding_similarities(pairs)
+
+    def compute_node_similarities(self, node, others):
+        """Compute similarities between 'node' and 'others' and return the result as a list.
+        """
+        return self.compute_node_embedding_similarities(node, others)
+
 """
 >>> sim = ComplExSimilarity()
 
@@ -447,7 +517,7 @@ class ComplExSimilarity(SimilarityMeasure):
 """
 
 
-class TransESimilarity(SimilarityMeasure):
+class TransESimilarity(EmbeddingSimilarity):
     """
     Similarity computations based on TransE graph embeddings.
     Currently these are 100-dimensional.
@@ -486,7 +556,7 @@ class TransESimilarity(SimilarityMeasure):
 """
 
 
-class TextSimilarity(SimilarityMeasure):
+class TextSimilarity(EmbeddingSimilarity):
     """
     Similarity computations based on text embeddings.  Currently, this is
     linked to specific text embeddings created from KGTK node lexicalizations.
@@ -561,11 +631,20 @@ class Node2VecSimilarity(SimilarityMeasure):
             cid = resdf['numid'].iloc[0]
             clabel = resdf['label'].iloc[0]
             similar = self.backend.get_node2vec_embeddings().wv.most_similar(cid, topn=topn)
+            # decode all neighbors at once if we have the reverse row index, one query each otherwise:
+            nodes = self.backend.get_embedding_row_nodes([int(numid) for numid, sim in similar], 'node2vec')
+            labels = self.backend.get_node_label_batch([node for node in nodes if node is not None]) if nodes is not None else {}
             rows = []
-            for numid, sim in similar:
-                resdf = self.backend.get_node_and_label_from_node2vec_emb_numid(numid, fmt='df')
-                qnode = resdf['node1'].iloc[0]
-                label = resdf['label'].iloc[0]
+            for i, (numid, sim) in enumerate(similar):
+                if nodes is not None:
+                    qnode = nodes[i]
+                    if qnode is None:
+                        continue
+                    label = labels.get(qnode)
+                else:
+                    resdf = self.backend.get_node_and_label_from_node2vec_emb_numid(numid, fmt='df')
+                    qnode = resdf['node1'].iloc[0]
+                    label = resdf['label'].iloc[0]
                 rows.append([c, qnode, cid, numid, clabel, label, round(sim, 3)])
             return pd.DataFrame(rows, columns=self.NODE2VEC_FRAME_COLUMNS)
         except KeyError:
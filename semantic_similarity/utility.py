@@ -8,6 +8,11 @@ import semantic_similarity.kypher as kypher
 
 
 config = json.load(open('semantic_similarity/config.json'))
+
+# number of pairs processed per vectorized step of 'pairwise_cosine_similarity', this bounds the
+# size of the temporary gathered matrices (e.g., 64k x 1024 float32s = 256MB for text embeddings):
+PAIRWISE_CHUNK_SIZE = config.get('pairwise_chunk_size', 65536)
+
 embeddings_to_index_field = {
     "complex": "graph_embedding_complex",
     "text": "text_embedding",
@@ -17,6 +22,9 @@ embeddings_to_index_field = {
 
 
 class Utility(object):
+
+    # all node detail fields, selected subsets of these can be requested via 'fields':
+    DETAIL_FIELDS = frozenset(['label'] + list(embeddings_to_index_field.keys()))
     
     def __init__(self):
         self.config = config
@@ -24,10 +32,18 @@ class Utility(object):
         self.api_version_1 = str(self.config.get('api_version')) == '1'
         self.backend = kypher.get_synced_backend()
 
-    def get_qnode_details_via_es(self, qnodes: List[str], labels_only=False) -> dict:
-        source_fields = ["labels.en"]
-        if not labels_only:
-            source_fields.extend([embeddings_to_index_field[k] for k in embeddings_to_index_field])
+    def get_detail_fields(self, labels_only=False, fields=None):
+        """Return the set of detail fields selected by 'labels_only' or 'fields', where
+        the default is to select all of them.
+        """
+        if fields is not None:
+            return frozenset(fields)
+        return frozenset(['label']) if labels_only else self.DETAIL_FIELDS
+
+    def get_qnode_details_via_es(self, qnodes: List[str], labels_only=False, fields=None) -> dict:
+        fields = self.get_detail_fields(labels_only, fields)
+        source_fields = ["labels.en"] if 'label' in fields else []
+        source_fields.extend([embeddings_to_index_field[k] for k in embeddings_to_index_field if k in fields])
 
         qnodes_dict = {}
         ids_query = {
@@ -74,76 +90,187 @@ class Utility(object):
         return qnodes_dict
 
     def normalize_label(self, label):
-        # TO DO: generalize this, currently assumes an LQ-string with an @en suffix:
-        return label[1:-4] if label is not None else ''
+        return kypher.normalize_label(label)
 
-    def get_qnode_details_via_kypher(self, qnodes: List[str], labels_only=False) -> dict:
+    def get_qnode_details_via_kypher(self, qnodes: List[str], labels_only=False, fields=None) -> dict:
         """Assembles the same data as 'get_qnode_details_via_es', but faster.
+        Only the detail fields selected by 'labels_only' or 'fields' are looked up.
         """
+        fields = self.get_detail_fields(labels_only, fields)
+        if self.backend.has_node_info_table() and not self.is_array_backed(fields):
+            return self.get_qnode_details_via_node_info(qnodes, fields)
+
         qnodes_dict = {}
-        for qnode in qnodes:
-            label = self.backend.get_node_label(qnode)
-            if label:
-                qnodes_dict[qnode] = {'label': self.normalize_label(label)}
-            if labels_only:
-                continue
+        if 'label' in fields:
+            # labels are retrieved for all nodes at once which is a single lookup into the
+            # precomputed label table for all nodes covered by it:
+            for qnode, label in self.backend.get_node_labels(qnodes).items():
+                qnodes_dict[qnode] = {'label': label}
 
-            for info_key in embeddings_to_index_field.keys():
-                if info_key == "class":
-                    counts = self.backend.get_class_counts_compact(qnode)
-                    if counts:
-                        qnodes_dict.setdefault(qnode, {})[info_key] = counts
-                else:
-                    embed = self.backend.get_node_embedding(qnode, info_key)
+        if 'class' in fields:
+            # class counts of all nodes are retrieved with a single batched query:
+            for qnode, counts in self.backend.get_class_counts_compact_batch(qnodes).items():
+                if counts:
+                    qnodes_dict.setdefault(qnode, {})['class'] = counts
+
+        # embeddings are retrieved for all nodes at once which is a single vectorized lookup
+        # if the backend has precomputed embedding row indexes:
+        for info_key in embeddings_to_index_field.keys():
+            if info_key != "class" and info_key in fields:
+                embeds = self.backend.get_node_embeddings(qnodes, info_key)
+                for qnode, embed in zip(qnodes, embeds):
                     if embed is not None:
                         qnodes_dict.setdefault(qnode, {})[info_key] = embed
         return qnodes_dict
 
+    def is_array_backed(self, fields):
+        """Return True if all detail 'fields' can be looked up in precomputed arrays
+        without any (or with only few) queries to the graph cache.  This loads the arrays
+        on demand, since they are not preloaded when serving from a single process.
+        """
+        for field in fields:
+            if field == 'label':
+                if self.backend.get_node_label_store() is None:
+                    return False
+            elif field == 'class' or self.backend.get_embedding_row_index(field) is None:
+                return False
+            else:
+                self.backend.get_embeddings(field)
+        return True
+
+    def get_qnode_details_via_node_info(self, qnodes: List[str], fields) -> dict:
+        """Assembles the same data as 'get_qnode_details_via_kypher' for the detail 'fields',
+        but with a single batched query to the node info table for all 'qnodes'.  Labels are
+        looked up separately if the table was built for a different language.
+        """
+        qnodes_dict = {}
+        labels = None
+        if 'label' in fields and not self.backend.has_node_info_labels():
+            labels = self.backend.get_node_labels(qnodes)
+            for qnode, label in labels.items():
+                qnodes_dict[qnode] = {'label': label}
+        for qnode, info in self.backend.get_nodes_info(qnodes).items():
+            details = qnodes_dict.get(qnode, {})
+            if 'label' in fields and labels is None and info['label']:
+                details['label'] = info['label']
+            if 'class' in fields and info['classcounts']:
+                details['class'] = info['classcounts']
+            for info_key in embeddings_to_index_field.keys():
+                numid = info.get(f'{info_key}emb_numid')
+                if info_key in fields and numid is not None:
+                    details[info_key] = self.backend.get_embeddings(info_key)[numid]
+            if details:
+                qnodes_dict[qnode] = details
+        return qnodes_dict
+
     # full cache of this size will occupy about 3GB of RAM (or half of that if we go to float32);
     # we use a class method to make sure we have exactly one cache, not one per instance
     # (lru_cache is thread-safe according to its source):
     @classmethod
     @lru_cache(maxsize=config['LRU_CACHE_SIZE'])
-    def get_qnode_details_cache(self, qnode, labels_only=False):
+    def get_qnode_details_cache(self, qnode):
         """Support per-node caching by returning a cache entry that can be modified outside.
         This primarily exists to provide a size-limited cache facility on a per-node basis.
+        Entries are [qnode, details, fetched] where 'fetched' is the set of detail fields
+        that have been looked up so far, so missing fields can be filled in on demand.
         """
-        return [qnode, None]
+        return [qnode, {}, frozenset()]
 
-    def get_qnode_details(self, qnodes: List[str], labels_only=False) -> dict:
-        """LRU-caching version of 'get_qnode_details_via_es/kypher'.  Only looks up those nodes
-        in 'qnodes' for which we currently don't have a cached version and LRU-caches them.
-        Otherwise returns the exact same data structure as 'get_qnode_details_via_es/kypher'.
+    def get_qnode_details(self, qnodes: List[str], labels_only=False, fields=None) -> dict:
+        """LRU-caching version of 'get_qnode_details_via_es/kypher'.  Only looks up those detail
+        fields selected by 'labels_only' or 'fields' (all by default) that we currently don't
+        have cached for each node in 'qnodes' and adds them to the node's cache entry.
+        Otherwise returns the same data structure as 'get_qnode_details_via_es/kypher',
+        where node details may include additional fields that were cached before.
         """
+        fields = self.get_detail_fields(labels_only, fields)
         all_caches = []
-        new_caches = []
+        # nodes are grouped by their set of missing fields, so each group is a single lookup:
+        new_caches = {}
         for qnode in qnodes:
-            cache = self.get_qnode_details_cache(qnode, labels_only=labels_only)
-            if cache[1] is None:
-                new_caches.append(cache)
+            cache = self.get_qnode_details_cache(qnode)
+            missing = fields.difference(cache[2])
+            if missing:
+                new_caches.setdefault(missing, []).append(cache)
             all_caches.append(cache)
-        if len(new_caches) > 0:
+        for missing, caches in new_caches.items():
             if self.api_version_1:
-                qnodes_dict = self.get_qnode_details_via_es([x[0] for x in new_caches], labels_only=labels_only)
+                qnodes_dict = self.get_qnode_details_via_es([x[0] for x in caches], fields=missing)
             else:
-                qnodes_dict = self.get_qnode_details_via_kypher([x[0] for x in new_caches], labels_only=labels_only)
-            for cache in new_caches:
-                # make sure to not break if we didn't get any result for a node;
-                # we mark those with {} so we don't try to look them up again:
-                cache[1] = qnodes_dict.get(cache[0], {})
-        return {qnode: info for qnode, info in all_caches if info}
+                qnodes_dict = self.get_qnode_details_via_kypher([x[0] for x in caches], fields=missing)
+            for cache in caches:
+                # make sure to not break if we didn't get any result for a node; we record the
+                # fields as fetched either way so we don't try to look them up again (we replace
+                # instead of update the set, since other threads might be reading it):
+                cache[1].update(qnodes_dict.get(cache[0], {}))
+                cache[2] = cache[2].union(missing)
+        return {qnode: info for qnode, info, fetched in all_caches if not fields.isdisjoint(info)}
 
 
-def cosine_similarity(x, y):
+def cosine_similarity(x, y, normalized=False):
     """Faster version of cosine similarity that does not do any arg checking
-    and expects two 1 or 2-dim numpy arrays as input.
+    and expects two 1 or 2-dim numpy arrays as input.  If 'normalized' is True,
+    rows are assumed to be unit-normalized already which reduces this to a matmul.
     """
     # dwim 1-dim vectors to single-element 2-dim views:
     if x.ndim == 1:
         x = x.reshape(1, -1)
     if y.ndim == 1:
         y = y.reshape(1, -1)
-    xnorm = x / np.linalg.norm(x, axis=1, keepdims=True)
-    ynorm = y / np.linalg.norm(y, axis=1, keepdims=True)
+    if not normalized:
+        x = x / np.linalg.norm(x, axis=1, keepdims=True)
+        y = y / np.linalg.norm(y, axis=1, keepdims=True)
     # TO DO: possibly coerce to full float type here:
-    return np.matmul(xnorm, ynorm.T)
+    return np.matmul(x, y.T)
+
+def _divide_by_norms(dots, norms):
+    # zero vectors would give us NaNs here, so we map those onto 0.0 instead:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num(dots / norms, nan=0.0, posinf=0.0, neginf=0.0)
+
+def pairwise_cosine_similarity(emb, idx1, idx2, norms=None, normalized=False, chunksize=PAIRWISE_CHUNK_SIZE):
+    """Compute cosine similarities between the row pairs 'emb[idx1[i]]' and 'emb[idx2[i]]'.
+    'emb' is a 2-dim numpy array or memmap, 'idx1' and 'idx2' are equal-length integer row
+    index sequences where negative indices mark missing values whose similarity will be 0.0.
+    Rows are gathered into contiguous float32 matrices 'chunksize' pairs at a time, so all
+    similarities of a chunk get computed in one vectorized pass.  If 'normalized' is True,
+    the rows of 'emb' are unit vectors and similarities are plain dot products, otherwise,
+    'norms' can supply precomputed row norms of 'emb'.  Returns a float32 array.
+    """
+    idx1 = np.asarray(idx1, dtype=np.int64)
+    idx2 = np.asarray(idx2, dtype=np.int64)
+    sims = np.zeros(len(idx1), dtype=np.float32)
+    valid = np.flatnonzero((idx1 >= 0) & (idx2 >= 0))
+    for start in range(0, len(valid), chunksize):
+        chunk = valid[start:start + chunksize]
+        rows1, rows2 = idx1[chunk], idx2[chunk]
+        x = np.ascontiguousarray(emb[rows1], dtype=np.float32)
+        y = np.ascontiguousarray(emb[rows2], dtype=np.float32)
+        dots = np.einsum('ij,ij->i', x, y)
+        if normalized:
+            sims[chunk] = dots
+        elif norms is not None:
+            sims[chunk] = _divide_by_norms(dots, norms[rows1] * norms[rows2])
+        else:
+            sims[chunk] = _divide_by_norms(dots, np.sqrt(np.einsum('ij,ij->i', x, x) * np.einsum('ij,ij->i', y, y)))
+    return sims
+
+def node_cosine_similarity(emb, idx, others, norms=None, normalized=False):
+    """Compute cosine similarities between row 'emb[idx]' and each of the rows 'emb[others[i]]'.
+    This is the one-vs-many version of 'pairwise_cosine_similarity' (which see for arguments).
+    """
+    others = np.asarray(others, dtype=np.int64)
+    sims = np.zeros(len(others), dtype=np.float32)
+    if idx < 0:
+        return sims
+    valid = np.flatnonzero(others >= 0)
+    x = np.asarray(emb[idx], dtype=np.float32)
+    y = np.ascontiguousarray(emb[others[valid]], dtype=np.float32)
+    dots = np.matmul(y, x)
+    if normalized:
+        sims[valid] = dots
+    elif norms is not None:
+        sims[valid] = _divide_by_norms(dots, norms[idx] * norms[others[valid]])
+    else:
+        sims[valid] = _divide_by_norms(dots, np.linalg.norm(x) * np.linalg.norm(y, axis=1))
+    return sims